@@ -0,0 +1,286 @@
+"""
+    Benchmarks the exporter against a fake Nokia gateway and a fake ClickHouse
+
+    Both fakes run locally on aiohttp, so the exporter can be measured as the
+    number of gateways grows without any real hardware. Each run's exporter
+    gets a fresh process of its own so its memory and latency don't include
+    the fakes or earlier runs, e.g.:
+
+        python bench.py --gateways 1,10,100,500 --duration 15
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+
+from aiohttp import web
+from time import perf_counter
+
+from tmobile import TMobile, ENDPOINTS
+
+class FakeGateway:
+    def __init__(self, latency:float, jitter:float, error_rate:float, payloads_dir:str=None):
+        """
+            Serves the Nokia gateway CGI endpoints for any number of gateways
+
+            Each gateway is served under its own path prefix (/<name>/...).
+            Responses are delayed by latency +/- jitter seconds and fail with a
+            500 at error_rate. Payloads are synthetic unless payloads_dir has
+            recorded radio.json, lan.json and device.json files.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+
+        # Recorded payloads by endpoint
+        self.recorded = {}
+        if payloads_dir:
+            for endpoint in ENDPOINTS:
+                with open(os.path.join(payloads_dir, f'{endpoint}.json')) as f:
+                    self.recorded[endpoint] = json.load(f)
+
+        # Ever-increasing interface counters by gateway
+        self.counters = {}
+
+        self.app = web.Application()
+        for endpoint, path in ENDPOINTS.items():
+            self.app.router.add_get(
+                f'/{{gateway}}{path.split("?")[0]}',
+                lambda request, endpoint=endpoint: self.handle(request, endpoint)
+            )
+
+    def _synthetic(self, gateway:str, endpoint:str) -> dict:
+        """
+            Returns a synthetic payload for an endpoint
+        """
+        counter = self.counters[gateway] = self.counters.get(gateway, 0) + random.randint(0, 10 ** 6)
+
+        if endpoint == 'radio':
+            return {
+                'cell_5G_stats_cfg': [{'stat': {
+                    'PhysicalCellID': random.choice((101, 102)), 'SNRCurrent': random.randint(0, 30),
+                    'RSRPCurrent': random.randint(-110, -70), 'RSRPStrengthIndexCurrent': random.randint(0, 100),
+                    'RSRQCurrent': random.randint(-20, -3), 'Downlink_NR_ARFCN': 126270,
+                    'SignalStrengthLevel': random.randint(1, 5), 'Band': 'n71'
+                }}],
+                'cell_LTE_stats_cfg': [{'stat': {
+                    'PhysicalCellID': 201, 'RSSICurrent': random.randint(-90, -50),
+                    'SNRCurrent': random.randint(0, 30), 'RSRPCurrent': random.randint(-110, -70),
+                    'RSRPStrengthIndexCurrent': random.randint(0, 100), 'RSRQCurrent': random.randint(-20, -3),
+                    'DownlinkEarfcn': 66786, 'SignalStrengthLevel': random.randint(1, 5), 'Band': 'B66'
+                }}],
+                'connection_status': [{'ConnectionStatus': 1}],
+                'cellular_stats': [{'BytesReceived': counter, 'BytesSent': counter // 4}],
+            }
+        if endpoint == 'lan':
+            return {
+                'lan_ether': [
+                    {'Status': 'Up', 'stat': {
+                        'BytesReceived': counter, 'BytesSent': counter // 2,
+                        'PacketsReceived': counter // 1000, 'PacketsSent': counter // 2000
+                    }},
+                    {'Status': 'Down', 'stat': {}},
+                ],
+                'wlan_status_glb': [
+                    {
+                        'Enable': 1, 'TotalBytesReceived': counter, 'TotalBytesSent': counter // 2,
+                        'TotalPacketsReceived': counter // 1000, 'TotalPacketsSent': counter // 2000
+                    },
+                    {'Enable': 0},
+                ],
+                'lan_ifip': {
+                    'X_ASB_COM_RxBytes': counter, 'X_ASB_COM_TxBytes': counter // 2,
+                    'X_ASB_COM_RxPackets': counter // 1000, 'X_ASB_COM_TxPackets': counter // 2000
+                },
+            }
+        return {
+            'device_app_status': [{'UpTime': counter // 10 ** 6, 'SoftwareVersion': '1.2103.00.0338', 'Description': 'FastMile 5G Gateway'}],
+            'device_cfg': [{'InterfaceType': 'Ethernet'}, {'InterfaceType': '802.11'}, {'InterfaceType': '802.11'}],
+        }
+
+    async def handle(self, request:web.Request, endpoint:str) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        if random.random() < self.error_rate:
+            return web.Response(status=500, text='Internal Server Error')
+        payload = self.recorded.get(endpoint) or self._synthetic(request.match_info['gateway'], endpoint)
+        return web.Response(text=json.dumps(payload), content_type='application/json')
+
+
+class FakeClickHouse:
+    def __init__(self):
+        """
+            Accepts ClickHouse HTTP inserts and throws the data away
+        """
+        self.requests = 0
+        self.bytes = 0
+
+        self.app = web.Application(client_max_size=1024 ** 3)
+        self.app.router.add_post('/', self.handle)
+
+    async def handle(self, request:web.Request) -> web.Response:
+        self.requests += 1
+        self.bytes += len(await request.read())
+        return web.Response(text='')
+
+
+class BenchTMobile(TMobile):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Duration of every scrape
+        self.scrape_durations = []
+
+    async def scrape(self, gateway, *args):
+        start = perf_counter()
+        try:
+            await super().scrape(gateway, *args)
+        finally:
+            self.scrape_durations.append(perf_counter() - start)
+
+
+async def start_server(app:web.Application) -> tuple:
+    """
+        Starts an app on a random local port and returns its runner and URL
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+def percentile(values:list, percent:float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def rss_mb() -> float:
+    """
+        Returns the current resident memory in MB, or the peak if it's not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def measure(env:dict, duration:float) -> dict:
+    """
+        Runs the exporter for duration seconds and returns what it did
+    """
+    os.environ.update(env)
+    tmobile = BenchTMobile(asyncio.get_running_loop())
+    task = asyncio.create_task(tmobile.run())
+    await asyncio.sleep(duration)
+    tmobile.event.set()
+    await task
+
+    return {
+        'scrapes': len(tmobile.scrape_durations),
+        'inserted': sum(value[-2] for value in tmobile.metric_insert_rows.values.values()),
+        'dropped': sum(tmobile.metric_rows_dropped.values.values()),
+        'p50': percentile(tmobile.scrape_durations, 50),
+        'p99': percentile(tmobile.scrape_durations, 99),
+        'rss': rss_mb(),
+    }
+
+
+def run_exporter(env:dict, duration:float) -> dict:
+    """
+        Entry point of the exporter's own process
+    """
+    return asyncio.run(measure(env, duration))
+
+
+async def bench(gateways:int, args:argparse.Namespace) -> dict:
+    """
+        Runs the exporter against the fakes with a number of gateways
+    """
+    gateway = FakeGateway(args.latency, args.jitter, args.error_rate, args.payloads)
+    clickhouse = FakeClickHouse()
+    gateway_runner, gateway_url = await start_server(gateway.app)
+    clickhouse_runner, clickhouse_url = await start_server(clickhouse.app)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump([
+            {'name': f'gateway{num}', 'url': f'{gateway_url}/gateway{num}'} for num in range(gateways)
+        ], f)
+        gateways_file = f.name
+
+    env = {
+        'GATEWAYS_FILE': gateways_file,
+        'CLICKHOUSE_URL': clickhouse_url,
+        'CLICKHOUSE_USER': 'bench',
+        'CLICKHOUSE_PASS': 'bench',
+        'CLICKHOUSE_DB': 'bench',
+        'FETCH_DELAY': str(args.fetch_delay),
+        'INSERT_BATCH_AGE': str(args.batch_age),
+        'LOG_LEVEL': str(args.log_level),
+        # Every fake gateway is on the same host
+        'GATEWAY_CONNECTIONS_PER_HOST': '0',
+        # Extra exporter settings to compare, e.g. INSERT_FORMAT=rowbinary
+        **dict(env.split('=', 1) for env in args.env),
+    }
+
+    try:
+        # A fresh process for every run, while the fakes keep serving from this one
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            result = await asyncio.get_running_loop().run_in_executor(pool, run_exporter, env, args.duration)
+    finally:
+        os.remove(gateways_file)
+        await gateway_runner.cleanup()
+        await clickhouse_runner.cleanup()
+
+    return {
+        'gateways': gateways,
+        'scrapes/s': result['scrapes'] / args.duration,
+        'rows/s': result['inserted'] / args.duration,
+        'inserts/s': clickhouse.requests / args.duration,
+        'dropped/s': result['dropped'] / args.duration,
+        'p50 (ms)': result['p50'] * 1000,
+        'p99 (ms)': result['p99'] * 1000,
+        'rss (MB)': result['rss'],
+    }
+
+
+async def main(args:argparse.Namespace):
+    results = []
+    for gateways in args.gateways:
+        print(f'Running with {gateways} gateways for {args.duration}s...', file=sys.stderr)
+        results.append(await bench(gateways, args))
+
+    columns = list(results[0])
+    print(' '.join(f'{column:>12}' for column in columns))
+    for result in results:
+        print(' '.join(
+            f'{result[column]:>12.2f}' if isinstance(result[column], float) else f'{result[column]:>12}'
+            for column in columns
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--gateways', default='1,10,100', type=lambda value: [int(num) for num in value.split(',')],
+                        help='Comma separated numbers of gateways to benchmark (default: 1,10,100)')
+    parser.add_argument('--duration', default=10, type=float, help='Seconds to run each benchmark for (default: 10)')
+    parser.add_argument('--fetch-delay', default=1, type=int, help='FETCH_DELAY to run the exporter with (default: 1)')
+    parser.add_argument('--batch-age', default=1, type=float, help='INSERT_BATCH_AGE to run the exporter with (default: 1)')
+    parser.add_argument('--env', default=[], action='append', help='Extra exporter environment variable (KEY=VALUE), can be repeated')
+    parser.add_argument('--latency', default=0.05, type=float, help='Fake gateway response latency in seconds (default: 0.05)')
+    parser.add_argument('--jitter', default=0.02, type=float, help='Fake gateway latency jitter in seconds (default: 0.02)')
+    parser.add_argument('--error-rate', default=0, type=float, help='Fraction of fake gateway responses that fail (default: 0)')
+    parser.add_argument('--payloads', help='Directory with recorded radio.json, lan.json and device.json payloads')
+    parser.add_argument('--log-level', default=40, type=int, help='Exporter LOG_LEVEL (default: 40)')
+
+    asyncio.run(main(parser.parse_args()))
@@ -1,6 +1,6 @@
 -- PLEASE NOTE
--- These buffer tables are what I personally use to buffer and batch inserts
--- You may have to modify them to work in your setup
+-- Inserts are batched by the exporter (INSERT_BATCH_ROWS/INSERT_BATCH_AGE), so no Buffer tables are needed
+-- You may have to modify these to work in your setup
 
 CREATE TABLE tmobile_status (
         gateway LowCardinality(String),
@@ -14,17 +14,13 @@ CREATE TABLE tmobile_status (
         time DateTime DEFAULT now()
     ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, time) PRIMARY KEY (gateway, time);
 
-CREATE TABLE tmobile_status_buffer (
+CREATE TABLE tmobile_endpoints (
         gateway LowCardinality(String),
-        uptime bigint,
-        connected boolean,
-        version LowCardinality(String),
-        model LowCardinality(String),
-        wired_devices smallint DEFAULT 0,
-        wireless_devices smallint DEFAULT 0,
-        scrape_latency float,
+        endpoint LowCardinality(String),
+        latency float,
+        success boolean,
         time DateTime DEFAULT now()
-    ) ENGINE = Buffer(homelab, tmobile_status, 1, 10, 10, 10, 100, 10000, 10000);
+    ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, endpoint, time) PRIMARY KEY (gateway, endpoint, time);
 
 CREATE TABLE tmobile_interfaces (
         gateway LowCardinality(String),
@@ -36,16 +32,6 @@ CREATE TABLE tmobile_interfaces (
         time DateTime DEFAULT now()
     ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, interface, time) PRIMARY KEY (gateway, interface, time);
 
-CREATE TABLE tmobile_interfaces_buffer (
-        gateway LowCardinality(String),
-        interface LowCardinality(String),
-        bytes_in UInt64,
-        bytes_out UInt64,
-        packets_in Nullable(UInt64),
-        packets_out Nullable(UInt64),
-        time DateTime DEFAULT now()
-    ) ENGINE = Buffer(homelab, tmobile_interfaces, 1, 10, 10, 10, 100, 10000, 10000);
-
 CREATE TABLE tmobile_5g (
         gateway LowCardinality(String),
         physical_cell_id smallint,
@@ -59,9 +45,10 @@ CREATE TABLE tmobile_5g (
         time DateTime DEFAULT now()
     ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, physical_cell_id, time) PRIMARY KEY (gateway, physical_cell_id, time);
 
-CREATE TABLE tmobile_5g_buffer (
+CREATE TABLE tmobile_lte (
         gateway LowCardinality(String),
         physical_cell_id smallint,
+        rssi smallint,
         snr tinyint,
         rsrp smallint,
         rsrp_strength_index smallint,
@@ -70,32 +57,92 @@ CREATE TABLE tmobile_5g_buffer (
         signal_strength_level tinyint,
         band LowCardinality(String),
         time DateTime DEFAULT now()
-    ) ENGINE = Buffer(homelab, tmobile_5g, 1, 10, 10, 10, 100, 10000, 10000);
+    ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, physical_cell_id, time) PRIMARY KEY (gateway, physical_cell_id, time);
 
-CREATE TABLE tmobile_lte (
+-- Rollups, only needed with ROLLUP_WINDOW set
+-- A window can be split over more than one row (e.g. over a restart), so aggregate by window when querying
+
+CREATE TABLE tmobile_5g_rollup (
         gateway LowCardinality(String),
         physical_cell_id smallint,
-        rssi smallint,
-        snr tinyint,
-        rsrp smallint,
-        rsrp_strength_index smallint,
-        rsrq tinyint,
         downlink_arfcn int,
-        signal_strength_level tinyint,
         band LowCardinality(String),
-        time DateTime DEFAULT now()
+        snr_min tinyint,
+        snr_max tinyint,
+        snr_avg double,
+        snr_last tinyint,
+        rsrp_min smallint,
+        rsrp_max smallint,
+        rsrp_avg double,
+        rsrp_last smallint,
+        rsrp_strength_index_min smallint,
+        rsrp_strength_index_max smallint,
+        rsrp_strength_index_avg double,
+        rsrp_strength_index_last smallint,
+        rsrq_min tinyint,
+        rsrq_max tinyint,
+        rsrq_avg double,
+        rsrq_last tinyint,
+        signal_strength_level_min tinyint,
+        signal_strength_level_max tinyint,
+        signal_strength_level_avg double,
+        signal_strength_level_last tinyint,
+        samples UInt32,
+        time DateTime
     ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, physical_cell_id, time) PRIMARY KEY (gateway, physical_cell_id, time);
 
-CREATE TABLE tmobile_lte_buffer (
+CREATE TABLE tmobile_lte_rollup (
         gateway LowCardinality(String),
         physical_cell_id smallint,
-        rssi smallint,
-        snr tinyint,
-        rsrp smallint,
-        rsrp_strength_index smallint,
-        rsrq tinyint,
         downlink_arfcn int,
-        signal_strength_level tinyint,
         band LowCardinality(String),
-        time DateTime DEFAULT now()
-    ) ENGINE = Buffer(homelab, tmobile_lte, 1, 10, 10, 10, 100, 10000, 10000);
\ No newline at end of file
+        rssi_min smallint,
+        rssi_max smallint,
+        rssi_avg double,
+        rssi_last smallint,
+        snr_min tinyint,
+        snr_max tinyint,
+        snr_avg double,
+        snr_last tinyint,
+        rsrp_min smallint,
+        rsrp_max smallint,
+        rsrp_avg double,
+        rsrp_last smallint,
+        rsrp_strength_index_min smallint,
+        rsrp_strength_index_max smallint,
+        rsrp_strength_index_avg double,
+        rsrp_strength_index_last smallint,
+        rsrq_min tinyint,
+        rsrq_max tinyint,
+        rsrq_avg double,
+        rsrq_last tinyint,
+        signal_strength_level_min tinyint,
+        signal_strength_level_max tinyint,
+        signal_strength_level_avg double,
+        signal_strength_level_last tinyint,
+        samples UInt32,
+        time DateTime
+    ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, physical_cell_id, time) PRIMARY KEY (gateway, physical_cell_id, time);
+
+CREATE TABLE tmobile_interfaces_rollup (
+        gateway LowCardinality(String),
+        interface LowCardinality(String),
+        bytes_in_min UInt64,
+        bytes_in_max UInt64,
+        bytes_in_avg double,
+        bytes_in_last UInt64,
+        bytes_out_min UInt64,
+        bytes_out_max UInt64,
+        bytes_out_avg double,
+        bytes_out_last UInt64,
+        packets_in_min Nullable(UInt64),
+        packets_in_max Nullable(UInt64),
+        packets_in_avg Nullable(double),
+        packets_in_last Nullable(UInt64),
+        packets_out_min Nullable(UInt64),
+        packets_out_max Nullable(UInt64),
+        packets_out_avg Nullable(double),
+        packets_out_last Nullable(UInt64),
+        samples UInt32,
+        time DateTime
+    ) ENGINE = MergeTree() PARTITION BY toYYYYMM(time) ORDER BY (gateway, interface, time) PRIMARY KEY (gateway, interface, time);
@@ -3,21 +3,1119 @@ import aiohttp
 import asyncio
 import colorlog
 import datetime
+import gzip
+import hashlib
 import logging
 import json
+import math
 import os
+import random
+import re
 import signal
+import struct
 import sys
 import uvloop
+import zlib
 uvloop.install()
 
-from time import perf_counter
+# lz4 is only needed for the lz4 insert compression
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# orjson and msgspec are faster JSON codecs used instead of json if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from aiohttp import web
+from array import array
+from operator import itemgetter
+from time import monotonic, perf_counter, time
+from urllib.parse import quote
 
 log = logging.getLogger('TMobile')
 
+# Columns of each table, in insert order
+# Each column has its ClickHouse type (which has to match tables.sql for the
+# RowBinary insert format) and the path to its value in the gateway endpoints,
+# starting with the endpoint name. Columns without a path are filled in by the exporter.
+TABLE_COLUMNS = {
+    '5g': (
+        ('gateway', 'String', None),
+        ('physical_cell_id', 'Int16', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'PhysicalCellID')),
+        ('snr', 'Int8', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'SNRCurrent')),
+        ('rsrp', 'Int16', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'RSRPCurrent')),
+        ('rsrp_strength_index', 'Int16', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'RSRPStrengthIndexCurrent')),
+        ('rsrq', 'Int8', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'RSRQCurrent')),
+        ('downlink_arfcn', 'Int32', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'Downlink_NR_ARFCN')),
+        ('signal_strength_level', 'Int8', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'SignalStrengthLevel')),
+        ('band', 'String', ('radio', 'cell_5G_stats_cfg', 0, 'stat', 'Band')),
+        ('time', 'DateTime', None),
+    ),
+    'lte': (
+        ('gateway', 'String', None),
+        ('physical_cell_id', 'Int16', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'PhysicalCellID')),
+        ('rssi', 'Int16', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'RSSICurrent')),
+        ('snr', 'Int8', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'SNRCurrent')),
+        ('rsrp', 'Int16', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'RSRPCurrent')),
+        ('rsrp_strength_index', 'Int16', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'RSRPStrengthIndexCurrent')),
+        ('rsrq', 'Int8', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'RSRQCurrent')),
+        ('downlink_arfcn', 'Int32', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'DownlinkEarfcn')),
+        ('signal_strength_level', 'Int8', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'SignalStrengthLevel')),
+        ('band', 'String', ('radio', 'cell_LTE_stats_cfg', 0, 'stat', 'Band')),
+        ('time', 'DateTime', None),
+    ),
+    'interfaces': (
+        ('gateway', 'String', None),
+        ('interface', 'String', None),
+        ('bytes_in', 'UInt64', None),
+        ('bytes_out', 'UInt64', None),
+        ('packets_in', 'Nullable(UInt64)', None),
+        ('packets_out', 'Nullable(UInt64)', None),
+        ('time', 'DateTime', None),
+    ),
+    'status': (
+        ('gateway', 'String', None),
+        ('uptime', 'Int64', ('device', 'device_app_status', 0, 'UpTime')),
+        ('connected', 'Bool', ('radio', 'connection_status', 0, 'ConnectionStatus')),
+        ('version', 'String', ('device', 'device_app_status', 0, 'SoftwareVersion')),
+        ('model', 'String', ('device', 'device_app_status', 0, 'Description')),
+        ('wired_devices', 'Int16', None),
+        ('wireless_devices', 'Int16', None),
+        ('scrape_latency', 'Float32', None),
+        ('time', 'DateTime', None),
+    ),
+    'endpoints': (
+        ('gateway', 'String', None),
+        ('endpoint', 'String', None),
+        ('latency', 'Float32', None),
+        ('success', 'Bool', None),
+        ('time', 'DateTime', None),
+    ),
+}
+
+# Tables that can be rolled up into min/max/avg/last per window
+# Each has the columns identifying a series and the columns that are aggregated
+ROLLUPS = {
+    '5g': (
+        ('gateway', 'physical_cell_id', 'downlink_arfcn', 'band'),
+        ('snr', 'rsrp', 'rsrp_strength_index', 'rsrq', 'signal_strength_level'),
+    ),
+    'lte': (
+        ('gateway', 'physical_cell_id', 'downlink_arfcn', 'band'),
+        ('rssi', 'snr', 'rsrp', 'rsrp_strength_index', 'rsrq', 'signal_strength_level'),
+    ),
+    'interfaces': (
+        ('gateway', 'interface'),
+        ('bytes_in', 'bytes_out', 'packets_in', 'packets_out'),
+    ),
+}
+
+
+def _rollup_columns(table:str) -> tuple:
+    """
+        Returns the columns of a table's rollup table
+
+        The series columns are followed by the min, max, avg and last of each
+        aggregated column, the number of samples and the start of the window
+    """
+    keys, aggregated = ROLLUPS[table]
+    types = {name: column_type for name, column_type, _ in TABLE_COLUMNS[table]}
+    return (
+        *((name, types[name], None) for name in keys),
+        *(
+            column
+            for name in aggregated
+            for column in (
+                (f'{name}_min', types[name], None),
+                (f'{name}_max', types[name], None),
+                (f'{name}_avg', 'Nullable(Float64)' if types[name].startswith('Nullable(') else 'Float64', None),
+                (f'{name}_last', types[name], None),
+            )
+        ),
+        ('samples', 'UInt32', None),
+        ('time', 'DateTime', None),
+    )
+
+
+TABLE_COLUMNS.update({f'{table}_rollup': _rollup_columns(table) for table in ROLLUPS})
+
+# struct formats and value conversions of fixed size RowBinary types
+ROWBINARY_TYPES = {
+    'Int8': ('<b', int),
+    'Int16': ('<h', int),
+    'Int32': ('<i', int),
+    'Int64': ('<q', int),
+    'UInt32': ('<I', int),
+    'UInt64': ('<Q', int),
+    'Float32': ('<f', float),
+    'Float64': ('<d', float),
+    'Bool': ('<?', lambda value: bool(int(value))),
+    'DateTime': ('<I', int),
+}
+
+
+def _rowbinary_column_encoder(column_type:str):
+    """
+        Creates a function that appends a value of a column type to a RowBinary buffer
+    """
+    if column_type.startswith('Nullable('):
+        encode_value = _rowbinary_column_encoder(column_type[9:-1])
+
+        def encode(buffer:bytearray, value):
+            # Nullable values are prefixed with a null flag byte
+            if value is None:
+                buffer.append(1)
+            else:
+                buffer.append(0)
+                encode_value(buffer, value)
+        return encode
+
+    if column_type == 'String':
+        def encode(buffer:bytearray, value):
+            value = str(value).encode()
+            # Strings are prefixed with their length as a LEB128 varint
+            length = len(value)
+            while length > 0x7f:
+                buffer.append((length & 0x7f) | 0x80)
+                length >>= 7
+            buffer.append(length)
+            buffer += value
+        return encode
+
+    fmt, convert = ROWBINARY_TYPES[column_type]
+    pack = struct.Struct(fmt).pack
+
+    def encode(buffer:bytearray, value):
+        buffer += pack(convert(value))
+    return encode
+
+
+def rowbinary_encoder(table:str):
+    """
+        Creates a function that appends a row of a table to a RowBinary buffer
+    """
+    encoders = tuple(
+        _rowbinary_column_encoder(column_type) for _, column_type, _ in TABLE_COLUMNS[table]
+    )
+
+    def encode(buffer:bytearray, row:tuple):
+        if len(row) != len(encoders):
+            raise ValueError(f'Expected {len(encoders)} columns, got {len(row)}')
+        for encode_column, value in zip(encoders, row):
+            encode_column(buffer, value)
+    return encode
+
+
+# Gateway CGI endpoints that get scraped
+ENDPOINTS = {
+    'radio': '/fastmile_radio_status_web_app.cgi',
+    'lan': '/lan_status_web_app.cgi?lan',
+    'device': '/dashboard_device_info_status_web_app.cgi',
+}
+
+
+class JsonCodec:
+    # Codecs by preference
+    NAMES = ('orjson', 'msgspec', 'json')
+
+    def __init__(self, name:str='auto'):
+        """
+            JSON codec parsing straight from bytes
+
+            Uses orjson or msgspec if installed, falling back to json. dumps
+            always returns bytes and loads takes bytes or str, whichever
+            library is used. Also passed to aiochclient, which only uses
+            dumps and loads.
+        """
+        if name == 'auto':
+            name = next(name for name in self.NAMES if name == 'json' or globals()[name] is not None)
+        if name not in self.NAMES:
+            raise ValueError(f'Unknown JSON codec {name}')
+        if name != 'json' and globals()[name] is None:
+            raise ValueError(f'{name} is not installed')
+
+        self.name = name
+        if name == 'orjson':
+            self.loads = orjson.loads
+            self.dumps = orjson.dumps
+        elif name == 'msgspec':
+            self.loads = msgspec.json.Decoder().decode
+            self.dumps = msgspec.json.Encoder().encode
+        else:
+            self.loads = json.loads
+            self.dumps = lambda obj: json.dumps(obj).encode()
+
+
+class Extractor:
+    def __init__(self, table:str):
+        """
+            Extracts a table's rows from the gateway endpoints
+
+            The column paths are compiled once so that each lookup shared by
+            several columns (e.g. the 5G stats dict) is only done once per row
+        """
+        columns = TABLE_COLUMNS[table]
+        self.size = len(columns)
+        # Endpoints the table's values come from
+        self.endpoints = frozenset(path[0] for _, _, path in columns if path is not None)
+
+        # Columns grouped by the path to the dict holding them
+        groups = {}
+        # Columns filled in by the exporter
+        self.computed = []
+        for index, (column, _, path) in enumerate(columns):
+            if path is None:
+                self.computed.append((index, column))
+            else:
+                groups.setdefault(path[:-1], []).append((index, path[-1]))
+
+        # Path to each dict, which columns its values go in and a getter for them
+        self.plan = []
+        for parent, leaves in groups.items():
+            indexes = tuple(index for index, _ in leaves)
+            keys = tuple(key for _, key in leaves)
+            if len(keys) == 1:
+                # itemgetter returns a single value instead of a tuple for one key
+                key = keys[0]
+                getter = lambda data, key=key: (data[key],)
+            else:
+                getter = itemgetter(*keys)
+            self.plan.append((parent, indexes, getter))
+
+    def extract(self, payloads:dict, values:dict) -> tuple:
+        """
+            Returns a row from the endpoint payloads, with computed columns taken from values
+
+            Raises KeyError/IndexError if the payloads don't have the data
+        """
+        row = [None] * self.size
+        for parent, indexes, getter in self.plan:
+            data = payloads
+            for key in parent:
+                data = data[key]
+            for index, value in zip(indexes, getter(data)):
+                row[index] = value
+        for index, column in self.computed:
+            row[index] = values[column]
+        return tuple(row)
+
+
+async def ticks(period:float, phase:float=0):
+    """
+        Yields on fixed deadlines every period seconds, offset by phase
+
+        The deadlines line up with the wall clock (e.g. a 10s period with a 5s
+        phase ticks at :05, :15, ...) so phases mean the same on every host,
+        but are slept on the monotonic clock so clock changes don't affect them.
+        Yields how many ticks were skipped since the last one, ticks missed
+        because the caller took too long are skipped instead of bunched up
+    """
+    loop = asyncio.get_running_loop()
+    # First deadline on the wall clock period grid after now, in loop time
+    now = time()
+    deadline = math.ceil((now - phase) / period) * period + phase - now + loop.time()
+    skipped = 0
+    while True:
+        await asyncio.sleep(deadline - loop.time())
+        yield skipped
+
+        deadline += period
+        # Skip any deadlines that already passed
+        skipped = max(math.ceil((loop.time() - deadline) / period), 0)
+        deadline += skipped * period
+
+
+def shard_of(name:str, shard_count:int) -> int:
+    """
+        Returns the shard a gateway belongs to using rendezvous hashing
+
+        Every shard scores the gateway and the highest score wins, so changing
+        the number of shards only moves the gateways won by an added shard (or
+        won by a removed one)
+    """
+    return max(
+        range(shard_count),
+        key=lambda shard: hashlib.blake2b(f'{shard}:{name}'.encode(), digest_size=8).digest()
+    )
+
+
+class InterfaceCounters:
+    __slots__ = ('endpoint', 'path', 'name', 'enabled', 'fields', 'missing', 'width')
+
+    def __init__(self, endpoint:str, path:tuple, name:str, enabled, fields:tuple, width:int=2 ** 64):
+        """
+            Describes where to find the counters of a group of interfaces in a gateway endpoint
+
+            path leads to either a list of interfaces or a single interface,
+            name is the interface name with {} replaced by the index in the list,
+            enabled is a function that checks if an interface is up (or None),
+            fields are the paths to bytes in/out and packets in/out (None if not available),
+            width is the range the counters wrap at (2 ** 32 for 32 bit counters)
+        """
+        self.endpoint = endpoint
+        self.path = path
+        self.name = name
+        self.enabled = enabled
+        self.fields = tuple(field for field in fields if field is not None)
+        # Number of trailing counters the API doesn't return
+        self.missing = len(fields) - len(self.fields)
+        self.width = width
+
+    def interfaces(self, payload:dict):
+        """
+            Yields the name and data of each enabled interface
+        """
+        data = payload
+        for key in self.path:
+            data = data[key]
+
+        if isinstance(data, list):
+            interfaces = ((self.name.format(num), iface) for num, iface in enumerate(data))
+        else:
+            interfaces = ((self.name, data),)
+
+        for name, iface in interfaces:
+            if self.enabled is None or self.enabled(iface):
+                yield name, iface
+
+    def values(self, iface:dict) -> tuple:
+        """
+            Returns the current counter values of an interface
+        """
+        values = []
+        for field in self.fields:
+            value = iface
+            for key in field:
+                value = value[key]
+            values.append(max(int(value), 0))
+        return values
+
+    def pad(self, deltas) -> tuple:
+        """
+            Pads deltas with None for the counters the API doesn't return
+        """
+        return (*deltas, *(None,) * self.missing)
+
+
+# Interface counters exported to the interfaces table
+INTERFACE_COUNTERS = (
+    # Ethernet ports
+    InterfaceCounters(
+        'lan', ('lan_ether',), 'eth{}',
+        lambda iface: iface['Status'] != 'Down',
+        (
+            ('stat', 'BytesReceived'), ('stat', 'BytesSent'),
+            ('stat', 'PacketsReceived'), ('stat', 'PacketsSent')
+        )
+    ),
+    # WLAN radios
+    InterfaceCounters(
+        'lan', ('wlan_status_glb',), 'wlan{}',
+        lambda iface: iface['Enable'] == 1,
+        (
+            ('TotalBytesReceived',), ('TotalBytesSent',),
+            ('TotalPacketsReceived',), ('TotalPacketsSent',)
+        )
+    ),
+    # LAN bridge
+    InterfaceCounters(
+        'lan', ('lan_ifip',), 'bridge', None,
+        (
+            ('X_ASB_COM_RxBytes',), ('X_ASB_COM_TxBytes',),
+            ('X_ASB_COM_RxPackets',), ('X_ASB_COM_TxPackets',)
+        )
+    ),
+    # Cellular
+    # The API doesn't return packets in/out on the cellular interface
+    InterfaceCounters(
+        'radio', ('cellular_stats', 0), 'cell', None,
+        (('BytesReceived',), ('BytesSent',), None, None)
+    ),
+)
+
+
+class CounterDeltas:
+    def __init__(self, state_dir:str=None, max_age:float=600):
+        """
+            Turns ever-increasing interface counters into deltas between samples
+
+            Counters are kept per gateway and interface as unsigned arrays. If
+            state_dir is set, each gateway's counters are saved to and loaded
+            from a file so a restart doesn't lose a sample. Saved counters older
+            than max_age seconds are ignored.
+        """
+        self.state_dir = state_dir
+        self.max_age = max_age
+        # Last counter values by gateway then interface
+        self.counters = {}
+
+        if self.state_dir:
+            os.makedirs(self.state_dir, exist_ok=True)
+
+    @staticmethod
+    def delta(previous:int, current:int, width:int=2 ** 64) -> int:
+        """
+            Returns the difference between two counter values
+
+            A counter that went down either wrapped (it was close to the top of
+            its width) or was reset (e.g. the gateway rebooted), in which case
+            everything counted since the reset is the delta
+        """
+        if current >= previous:
+            return current - previous
+        # Only treat it as a wrap if the counter was in the top quarter of its range
+        if width // 4 * 3 <= previous < width:
+            return width - previous + current
+        return current
+
+    def update(self, gateway:str, interface:str, values:list, width:int=2 ** 64) -> list:
+        """
+            Stores new counter values for an interface and returns the deltas
+
+            width is the range the counters wrap at. Returns None if there's
+            nothing to compare to yet
+        """
+        counters = self.counters.setdefault(gateway, {})
+        previous = counters.get(interface)
+        counters[interface] = array('Q', values)
+
+        # First sample or the set of counters changed
+        if previous is None or len(previous) != len(values):
+            return None
+        return [self.delta(prev, cur, width) for prev, cur in zip(previous, values)]
+
+    def _path(self, gateway:str) -> str:
+        return os.path.join(self.state_dir, f'{quote(gateway, safe="")}.json')
+
+    def load(self, gateway:str):
+        """
+            Loads a gateway's saved counters
+        """
+        if not self.state_dir:
+            return
+        try:
+            with open(self._path(gateway)) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.error(f'Failed to load saved counters for {gateway}: {e}')
+            return
+
+        age = time() - state.get('time', 0)
+        if age > self.max_age:
+            log.info(f'Ignoring saved counters for {gateway}, they are {round(age)}s old')
+            return
+
+        self.counters[gateway] = {
+            interface: array('Q', values) for interface, values in state['counters'].items()
+        }
+        log.debug(f'Loaded saved counters for {gateway} from {round(age)}s ago')
+
+    def save(self, gateway:str):
+        """
+            Saves a gateway's counters
+        """
+        if not self.state_dir or gateway not in self.counters:
+            return
+        path = self._path(gateway)
+        try:
+            # Write to a temporary file first so a crash can't leave a partial file
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump({
+                    'time': time(),
+                    'counters': {
+                        interface: values.tolist() for interface, values in self.counters[gateway].items()
+                    }
+                }, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            log.error(f'Failed to save counters for {gateway}: {e}')
+
+
+class RowDeduplicator:
+    # Columns that change on every scrape and aren't compared
+    IGNORED_COLUMNS = ('scrape_latency', 'time')
+    # Ever-increasing columns that are only compared for going down (e.g. a reboot)
+    INCREASING_COLUMNS = ('uptime',)
+
+    def __init__(self, tables:list, heartbeat:float):
+        """
+            Drops rows that haven't changed since the last one written
+
+            The last row written for each gateway and table is remembered, and
+            a row that's the same is only written again once heartbeat seconds
+            have passed so the table still shows the gateway is alive. Time is
+            taken from the rows' time column so replays keep their heartbeats
+        """
+        self.heartbeat = heartbeat
+        # Indexes of the compared columns, increasing columns and time column by table
+        self.columns = {}
+        for table in tables:
+            names = [name for name, _, _ in TABLE_COLUMNS[table]]
+            self.columns[table] = (
+                tuple(i for i, name in enumerate(names) if name not in (*self.IGNORED_COLUMNS, *self.INCREASING_COLUMNS)),
+                tuple(i for i, name in enumerate(names) if name in self.INCREASING_COLUMNS),
+                names.index('time'),
+            )
+        # Compared values, increasing values and time of the last row written by gateway and table
+        self.last = {}
+
+    def changed(self, gateway:str, table:str, row:tuple) -> bool:
+        """
+            Returns whether a row needs writing, remembering it if it does
+        """
+        if (columns := self.columns.get(table)) is None:
+            return True
+        compared, increasing, time_index = columns
+        values = tuple(row[i] for i in compared)
+        increasing_values = tuple(row[i] for i in increasing)
+        now = row[time_index]
+
+        last = self.last.get((gateway, table))
+        if (
+            last is not None
+            and last[0] == values
+            and all(cur >= prev for prev, cur in zip(last[1], increasing_values))
+            and now - last[2] < self.heartbeat
+        ):
+            self.last[gateway, table] = (values, increasing_values, last[2])
+            return False
+
+        self.last[gateway, table] = (values, increasing_values, now)
+        return True
+
+    def forget(self, gateway:str, table:str):
+        """
+            Forgets the last row of a table so the next one is always written
+
+            Used when a gateway stops reporting a table (e.g. 5G disconnected)
+            so it coming back is written straight away
+        """
+        self.last.pop((gateway, table), None)
+
+
+class Rollups:
+    def __init__(self, tables:list, window:float, raw_sample:float=1):
+        """
+            Aggregates rows into min/max/avg/last per series over fixed windows
+
+            Windows line up with the wall clock (e.g. on the minute), and a
+            window is finished once a row from the next window comes in for
+            its series or it has been over for another whole window. Every
+            row is aggregated, but only raw_sample of them (0 to 1) are
+            kept as raw rows.
+        """
+        self.window = window
+        self.raw_sample = raw_sample
+        # Indexes of the series columns, aggregated columns and time by table
+        self.columns = {}
+        for table in tables:
+            keys, aggregated = ROLLUPS[table]
+            names = [name for name, _, _ in TABLE_COLUMNS[table]]
+            self.columns[table] = (
+                tuple(names.index(name) for name in keys),
+                tuple(names.index(name) for name in aggregated),
+                names.index('time'),
+            )
+        # Window being aggregated by table then series
+        # Each is the window start, number of samples and [min, max, sum, count, last] of each column
+        self.series = {table: {} for table in tables}
+        # Fraction of a raw row owed by sampling by table and series
+        self.credit = {}
+
+    def add(self, table:str, row:tuple) -> list:
+        """
+            Adds a row to its series and returns any rollup rows it finished
+        """
+        keys, aggregated, time_index = self.columns[table]
+        series = self.series[table]
+        key = tuple(row[i] for i in keys)
+        start = math.floor(row[time_index] / self.window) * self.window
+
+        finished = []
+        window = series.get(key)
+        if window is not None and window[0] != start:
+            finished.append(self._row(key, window))
+            window = None
+        if window is None:
+            window = series[key] = [start, 0, [[None, None, 0, 0, None] for _ in aggregated]]
+
+        window[1] += 1
+        for stats, i in zip(window[2], aggregated):
+            # Nullable columns that are null are left out of the aggregates
+            if (value := row[i]) is None:
+                continue
+            if stats[3] == 0:
+                stats[0] = stats[1] = value
+            elif value < stats[0]:
+                stats[0] = value
+            elif value > stats[1]:
+                stats[1] = value
+            stats[2] += value
+            stats[3] += 1
+            stats[4] = value
+        return finished
+
+    def sample(self, table:str, row:tuple) -> bool:
+        """
+            Returns whether a raw row should be kept
+
+            Rows of each series are kept evenly (e.g. every 4th row for 0.25)
+            rather than at random
+        """
+        if self.raw_sample >= 1:
+            return True
+        key = (table, *(row[i] for i in self.columns[table][0]))
+        credit = self.credit.get(key, 0) + self.raw_sample
+        keep = credit >= 1
+        self.credit[key] = credit - 1 if keep else credit
+        return keep
+
+    def expired(self, now:float) -> dict:
+        """
+            Returns the rollup rows of series that stopped getting rows, by table
+        """
+        tables = {}
+        for table, series in self.series.items():
+            for key in [key for key, window in series.items() if window[0] + 2 * self.window <= now]:
+                tables.setdefault(table, []).append(self._row(key, series.pop(key)))
+        return tables
+
+    def flush(self) -> dict:
+        """
+            Returns the rollup rows of every unfinished window, by table
+        """
+        tables = {}
+        for table, series in self.series.items():
+            if series:
+                tables[table] = [self._row(key, window) for key, window in series.items()]
+                series.clear()
+        return tables
+
+    @staticmethod
+    def _row(key:tuple, window:list) -> tuple:
+        start, samples, stats = window
+        return (
+            *key,
+            *(
+                value
+                for minimum, maximum, total, count, last in stats
+                for value in (minimum, maximum, total / count if count else None, last)
+            ),
+            samples,
+            start,
+        )
+
+
+class Gateway:
+    def __init__(self, name:str, url:str, phase:float=None):
+        # Name used in the gateway column
+        self.name = name
+        # Base URL of the gateway's web interface
+        self.url = url.rstrip('/')
+        # Offset of the gateway's scrapes within FETCH_DELAY, None to use FETCH_PHASE
+        self.phase = phase
+        # Latest data of each endpoint, reused by scrapes that don't fetch it
+        self.payloads = dict.fromkeys(ENDPOINTS)
+
+
+class Spool:
+    def __init__(self, path:str, max_bytes:int, segment_bytes:int, codec:JsonCodec=None):
+        """
+            Append-only on-disk spool of rows that couldn't be queued for insertion
+
+            Rows are written as JSON lines to numbered segment files. Once the
+            total size goes over max_bytes the oldest segments are dropped.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.codec = codec or JsonCodec()
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Closed segments waiting to be replayed, oldest first
+        self.segments = sorted(
+            name for name in os.listdir(self.path) if name.endswith('.jsonl')
+        )
+        # Size of each segment in bytes
+        self.sizes = {
+            name: os.path.getsize(os.path.join(self.path, name)) for name in self.segments
+        }
+        # Next segment number, following any segments left from a previous run
+        self.next_segment = int(self.segments[-1].split('.')[0]) + 1 if self.segments else 0
+
+        # Total bytes dropped because the spool was full
+        self.dropped_bytes = 0
+
+        # Segment currently being written to
+        self.current = None
+        self.current_file = None
+
+        if self.segments:
+            log.info(f'Found {len(self.segments)} spooled segments ({self.size} bytes) to replay')
+
+    @property
+    def size(self) -> int:
+        """
+            Total size of the spool in bytes
+        """
+        return sum(self.sizes.values())
+
+    def __bool__(self) -> bool:
+        return bool(self.segments or self.current)
+
+    def append(self, table:str, rows:list):
+        """
+            Appends rows for a table to the spool
+        """
+        if self.current is None:
+            self.current = f'{self.next_segment:012d}.jsonl'
+            self.next_segment += 1
+            self.current_file = open(os.path.join(self.path, self.current), 'ab')
+            self.sizes[self.current] = 0
+
+        line = self.codec.dumps([table, rows]) + b'\n'
+        self.current_file.write(line)
+        self.current_file.flush()
+        self.sizes[self.current] += len(line)
+
+        # Start a new segment once the current one is full
+        if self.sizes[self.current] >= self.segment_bytes:
+            self._close_current()
+
+        # Drop the oldest segments if the spool is too big
+        while self.size > self.max_bytes and self.segments:
+            oldest = self.segments.pop(0)
+            log.error(f'Spool is full, dropping segment {oldest} ({self.sizes[oldest]} bytes)')
+            self.dropped_bytes += self.sizes[oldest]
+            self._remove(oldest)
+
+    def _close_current(self):
+        """
+            Closes the segment being written to so it can be replayed
+        """
+        self.current_file.close()
+        self.segments.append(self.current)
+        self.current = None
+        self.current_file = None
+
+    def _remove(self, segment:str):
+        """
+            Deletes a segment from disk
+        """
+        del self.sizes[segment]
+        try:
+            os.remove(os.path.join(self.path, segment))
+        except FileNotFoundError:
+            pass
+
+    def oldest(self) -> str:
+        """
+            Returns the oldest segment, closing the current one if it's the only one left
+        """
+        if not self.segments and self.current is not None:
+            self._close_current()
+        return self.segments[0] if self.segments else None
+
+    def read(self, segment:str) -> dict:
+        """
+            Reads a segment and returns its rows grouped by table
+        """
+        tables = {}
+        with open(os.path.join(self.path, segment), 'rb') as f:
+            for line in f:
+                try:
+                    table, rows = self.codec.loads(line)
+                except ValueError:
+                    # Partially written line from a crash
+                    log.error(f'Skipping invalid line in spool segment {segment}')
+                    continue
+                # JSON turns tuples into lists, turn them back so they insert as rows
+                tables.setdefault(table, []).extend(tuple(row) for row in rows)
+        return tables
+
+    def remove(self, segment:str):
+        """
+            Removes a segment once it has been replayed
+        """
+        # The segment may have already been dropped if the spool filled up
+        if segment in self.segments:
+            self.segments.remove(segment)
+            self._remove(segment)
+
+    def close(self):
+        """
+            Closes the segment being written to
+        """
+        if self.current is not None:
+            self._close_current()
+
+
+class Recorder:
+    def __init__(self, path:str, segment_bytes:int, codec:JsonCodec=None):
+        """
+            Records what gateways returned so it can be replayed later
+
+            Every scrape is appended as a JSON line with the gateway, time,
+            latency and the data of each fetched endpoint to gzipped segment
+            files, a new one is started once segment_bytes (uncompressed) have
+            been written
+        """
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.codec = codec or JsonCodec()
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Segment currently being written to and how much has been written to it
+        self.current_file = None
+        self.current_size = 0
+
+    def append(self, gateway:str, timestamp:float, latency:float, fetched:dict):
+        """
+            Appends a scrape to the current segment
+        """
+        if self.current_file is None:
+            # Named by when they were started, plus the pid in case exporters share the directory
+            started = datetime.datetime.now(tz=datetime.timezone.utc)
+            name = f'{started:%Y%m%dT%H%M%S}-{os.getpid()}.jsonl.gz'
+            # Fast compression since segments are written all the time
+            self.current_file = gzip.open(os.path.join(self.path, name), 'ab', compresslevel=1)
+            self.current_size = 0
+
+        line = self.codec.dumps({
+            'gateway': gateway,
+            'time': timestamp,
+            'latency': latency,
+            'endpoints': fetched,
+        }) + b'\n'
+        self.current_file.write(line)
+        self.current_size += len(line)
+
+        # Start a new segment once the current one is full
+        if self.current_size >= self.segment_bytes:
+            self.close()
+
+    def close(self):
+        """
+            Closes the segment being written to
+        """
+        if self.current_file is not None:
+            self.current_file.close()
+            self.current_file = None
+
+    @staticmethod
+    def read(path:str, codec:JsonCodec=None):
+        """
+            Yields the scrapes recorded in a segment
+        """
+        codec = codec or JsonCodec()
+        try:
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        yield codec.loads(line)
+                    except ValueError:
+                        log.error(f'Skipping invalid line in recording {path}')
+        except (EOFError, OSError, zlib.error) as e:
+            # Segment that wasn't closed properly (e.g. a crash)
+            log.error(f'Recording {path} is truncated: {e}')
+
+
+# ClickHouse error codes that mean it's overloaded or (partly) down rather than rejecting the batch
+# (TIMEOUT_EXCEEDED, TOO_SLOW, TOO_MANY_SIMULTANEOUS_QUERIES, SOCKET_TIMEOUT, NETWORK_ERROR,
+# NO_ZOOKEEPER, MEMORY_LIMIT_EXCEEDED, TABLE_IS_READ_ONLY, TOO_MANY_PARTS, ALL_CONNECTION_TRIES_FAILED,
+# UNKNOWN_STATUS_OF_INSERT, KEEPER_EXCEPTION)
+RETRYABLE_CLICKHOUSE_CODES = {159, 160, 202, 209, 210, 225, 241, 242, 252, 279, 319, 999}
+
+
+def clickhouse_unavailable(error:Exception) -> bool:
+    """
+        Returns whether an insert failed because ClickHouse is unreachable or
+        overloaded, rather than because it rejected the batch
+
+        Errors without a ClickHouse error code (e.g. a 502/503 from a proxy)
+        count as unavailable
+    """
+    if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError)):
+        return True
+    if not isinstance(error, aiochclient.ChClientError):
+        return False
+    code = re.match(r'\s*Code: (\d+)', f'{error}')
+    return code is None or int(code[1]) in RETRYABLE_CLICKHOUSE_CODES
+
+
+class CircuitBreaker:
+    def __init__(self, threshold:int, cooldown:float):
+        """
+            Pauses everyone using ClickHouse while it's down
+
+            The breaker opens after threshold failures in a row. Once it has
+            been open for cooldown seconds a single caller is let through to
+            probe ClickHouse, closing the breaker if it succeeds or opening it
+            again if it fails.
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        # Failures in a row
+        self.failures = 0
+        # When the breaker was opened, None while closed
+        self.opened_at = None
+        # Whether a probe is in progress
+        self.probing = False
+        self.condition = asyncio.Condition()
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    async def wait(self):
+        """
+            Waits until the breaker is closed or it's this caller's turn to probe
+        """
+        async with self.condition:
+            while self.opened_at is not None:
+                remaining = self.opened_at + self.cooldown - monotonic()
+                if remaining <= 0 and not self.probing:
+                    self.probing = True
+                    return
+                try:
+                    # Wait for the probe result or the end of the cooldown
+                    async with asyncio.timeout(remaining if remaining > 0 else None):
+                        await self.condition.wait()
+                except asyncio.TimeoutError:
+                    pass
+
+    async def success(self):
+        """
+            Records that ClickHouse is reachable
+        """
+        self.failures = 0
+        if self.opened_at is None:
+            return
+        log.info('ClickHouse is reachable again, resuming inserts')
+        async with self.condition:
+            self.opened_at = None
+            self.probing = False
+            self.condition.notify_all()
+
+    async def failure(self):
+        """
+            Records that ClickHouse is unreachable
+        """
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            log.warning(f'ClickHouse is unreachable, pausing inserts for {self.cooldown}s')
+            async with self.condition:
+                self.opened_at = monotonic()
+                self.probing = False
+                self.condition.notify_all()
+
+
+class Metric:
+    def __init__(self, name:str, help:str, kind:str, labels:tuple=(), buckets:tuple=None, callback=None):
+        """
+            A Prometheus metric (counter, gauge or histogram) with optional labels
+
+            If a callback is passed it's called on every scrape to get the value
+        """
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.buckets = buckets
+        self.callback = callback
+        # Values by label values
+        self.values = {}
+
+    def inc(self, value:float=1, *labels):
+        """
+            Increments a counter or gauge
+        """
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def set(self, value:float, *labels):
+        """
+            Sets a gauge
+        """
+        self.values[labels] = value
+
+    def observe(self, value:float, *labels):
+        """
+            Adds an observation to a histogram
+        """
+        if (histogram := self.values.get(labels)) is None:
+            # Bucket counts, then the sum and count of all observations
+            histogram = self.values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def _labels(self, labels:tuple, extra:str='') -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, labels)]
+        if extra:
+            pairs.append(extra)
+        return f'{{{",".join(pairs)}}}' if pairs else ''
+
+    def render(self) -> str:
+        """
+            Renders the metric in the Prometheus text format
+        """
+        if self.callback is not None:
+            self.values[()] = self.callback()
+
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in self.values.items():
+            if self.kind != 'histogram':
+                lines.append(f'{self.name}{self._labels(labels)} {value}')
+                continue
+            for bucket, count in zip((*self.buckets, '+Inf'), (*value[:-2], value[-1])):
+                le = f'le="{bucket}"'
+                lines.append(f'{self.name}_bucket{self._labels(labels, le)} {count}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {value[-2]}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {value[-1]}')
+        return '\n'.join(lines)
+
+
+class Metrics:
+    def __init__(self):
+        """
+            Registry of the exporter's own metrics
+        """
+        self.metrics = []
+
+    def add(self, *args, **kwargs) -> Metric:
+        """
+            Creates and registers a metric
+        """
+        metric = Metric(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+            Renders all metrics in the Prometheus text format
+        """
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
 
 class TMobile:
-    def __init__(self, loop:asyncio.AbstractEventLoop):
+    def __init__(self, loop:asyncio.AbstractEventLoop, replay:bool=False):
+        # Whether recordings are being replayed instead of gateways being scraped
+        self.replaying = replay
+
         # Setup logging
         self._setup_logging()
         # Load and check environment variables
@@ -28,434 +1126,1396 @@ class TMobile:
         # Event to stop the loop in case of SIGTERM
         self.event = asyncio.Event()
 
-        # Queue of data waiting to be inserted into ClickHouse
-        # This is in case ClickHouse goes down or something
-        self.data_queue = asyncio.Queue(maxsize=self.data_queue_limit)
+        # Queue of data waiting to be inserted into ClickHouse
+        # This is in case ClickHouse goes down or something
+        self.data_queue = asyncio.Queue(maxsize=self.data_queue_limit)
+
+        # Rows waiting to be batched into a single insert, per table
+        self.pending_rows = {}
+        # When the oldest pending row of each table was added
+        self.pending_since = {}
+
+        # Records what gateways returned, never while replaying
+        self.recorder = None
+        if self.record_dir and not self.replaying:
+            self.recorder = Recorder(self.record_dir, self.record_segment_bytes, self.json_codec)
+
+        # Interface counter deltas for all the gateways
+        self.counters = CounterDeltas(self.counter_state_dir, self.counter_state_max_age)
+
+        # Drops unchanged rows between heartbeats, disabled if DEDUP_HEARTBEAT is 0
+        self.dedup = RowDeduplicator(self.dedup_tables, self.dedup_heartbeat) if self.dedup_heartbeat else None
+
+        # Aggregates rows into rollup tables, disabled if ROLLUP_WINDOW is 0
+        self.rollups = Rollups(self.rollup_tables, self.rollup_window, self.rollup_raw_sample) if self.rollup_window else None
+
+        # Row extractors for each table that has values from the gateway endpoints
+        self.extractors = {
+            table: Extractor(table) for table, columns in TABLE_COLUMNS.items()
+            if any(path is not None for _, _, path in columns)
+        }
+
+        # RowBinary row encoders for each table
+        self.rowbinary_encoders = {
+            table: rowbinary_encoder(table) for table in TABLE_COLUMNS
+        }
+
+        # Batches waiting to be inserted by each insert worker
+        # Kept short so a slow ClickHouse backs up into the data queue (and spool)
+        self.insert_queues = [asyncio.Queue(maxsize=2) for _ in range(self.insert_workers)]
+        # Insert queue of each table, spread over the workers in turn
+        self.table_queues = {
+            table: self.insert_queues[num % len(self.insert_queues)] for num, table in enumerate(TABLE_COLUMNS)
+        }
+        # Pauses all insert workers while ClickHouse is down
+        self.breaker = CircuitBreaker(self.insert_breaker_failures, self.insert_breaker_cooldown)
+
+        # Whether the last insert into ClickHouse succeeded
+        self.clickhouse_healthy = False
+
+        # On-disk spool for rows that don't fit in the queue
+        self.spool = None
+        if self.spool_dir:
+            self.spool = Spool(self.spool_dir, self.spool_max_bytes, self.spool_segment_bytes, self.json_codec)
+
+        # The exporter's own metrics
+        self._setup_metrics()
+
+        # Limits how many gateways are scraped at the same time
+        self.gateway_semaphore = asyncio.Semaphore(self.gateway_concurrency)
+
+    def _setup_metrics(self):
+        """
+            Sets up the exporter's own metrics
+        """
+        self.metrics = Metrics()
+        latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+
+        self.metric_scrape_latency = self.metrics.add(
+            'tmobile_scrape_latency_seconds', 'Gateway endpoint fetch latency',
+            'histogram', ('endpoint',), latency_buckets
+        )
+        self.metric_scrape_errors = self.metrics.add(
+            'tmobile_scrape_errors_total', 'Failed gateway endpoint fetches',
+            'counter', ('endpoint',)
+        )
+        self.metric_scrapes_skipped = self.metrics.add(
+            'tmobile_scrapes_skipped_total', 'Scrapes skipped because the previous one overran FETCH_DELAY',
+            'counter'
+        )
+        self.metrics.add(
+            'tmobile_data_queue_depth', 'Items waiting in the data queue',
+            'gauge', callback=self.data_queue.qsize
+        )
+        self.metrics.add(
+            'tmobile_data_queue_limit', 'Max items in the data queue',
+            'gauge', callback=lambda: self.data_queue_limit
+        )
+        self.metrics.add(
+            'tmobile_pending_rows', 'Rows batched and waiting to be inserted',
+            'gauge', callback=lambda: sum(len(rows) for rows in self.pending_rows.values())
+        )
+        self.metric_http_in_flight = self.metrics.add(
+            'tmobile_http_requests_in_flight', 'HTTP requests waiting for a response',
+            'gauge', ('pool',)
+        )
+        self.metric_http_pool_wait = self.metrics.add(
+            'tmobile_http_pool_wait_seconds', 'Time HTTP requests waited for a free connection',
+            'histogram', ('pool',), latency_buckets
+        )
+        self.metric_http_connections = self.metrics.add(
+            'tmobile_http_connections_total', 'HTTP connections used, new or reused from the pool',
+            'counter', ('pool', 'type')
+        )
+        self.metric_insert_latency = self.metrics.add(
+            'tmobile_insert_latency_seconds', 'ClickHouse insert latency',
+            'histogram', ('table',), latency_buckets
+        )
+        self.metric_insert_rows = self.metrics.add(
+            'tmobile_insert_batch_rows', 'Rows per ClickHouse insert',
+            'histogram', ('table',), (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+        )
+        self.metric_insert_retries = self.metrics.add(
+            'tmobile_insert_retries_total', 'Failed ClickHouse inserts that were retried',
+            'counter', ('table',)
+        )
+        self.metric_rows_dropped = self.metrics.add(
+            'tmobile_rows_dropped_total', 'Rows dropped before being inserted',
+            'counter', ('table', 'reason')
+        )
+        self.metric_rows_dead_lettered = self.metrics.add(
+            'tmobile_rows_dead_lettered_total', 'Rows given up on after INSERT_MAX_ATTEMPTS',
+            'counter', ('table',)
+        )
+        self.metrics.add(
+            'tmobile_insert_breaker_open', 'Whether inserts are paused because ClickHouse is down',
+            'gauge', callback=lambda: int(self.breaker.open)
+        )
+        self.metric_rows_deduplicated = self.metrics.add(
+            'tmobile_rows_deduplicated_total', 'Unchanged rows that were skipped',
+            'counter', ('table',)
+        )
+        self.metric_rows_spooled = self.metrics.add(
+            'tmobile_rows_spooled_total', 'Rows spooled to disk',
+            'counter', ('table',)
+        )
+        if self.spool is not None:
+            self.metrics.add(
+                'tmobile_spool_bytes', 'Size of the on-disk spool',
+                'gauge', callback=lambda: self.spool.size
+            )
+            self.metrics.add(
+                'tmobile_spool_dropped_bytes_total', 'Spooled data dropped because the spool was full',
+                'counter', callback=lambda: self.spool.dropped_bytes
+            )
+        self.metric_loop_lag = self.metrics.add(
+            'tmobile_event_loop_lag_seconds', 'How late the event loop runs scheduled callbacks',
+            'histogram', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+        )
+
+    def _setup_logging(self):
+        """
+            Sets up logging colors and formatting
+        """
+        # Create a new handler with colors and formatting
+        shandler = logging.StreamHandler(stream=sys.stdout)
+        shandler.setFormatter(colorlog.LevelFormatter(
+            fmt={
+                'DEBUG': '{log_color}{asctime} [{levelname}] {message}',
+                'INFO': '{log_color}{asctime} [{levelname}] {message}',
+                'WARNING': '{log_color}{asctime} [{levelname}] {message}',
+                'ERROR': '{log_color}{asctime} [{levelname}] {message}',
+                'CRITICAL': '{log_color}{asctime} [{levelname}] {message}',
+            },
+            log_colors={
+                'DEBUG': 'blue',
+                'INFO': 'white',
+                'WARNING': 'yellow',
+                'ERROR': 'red',
+                'CRITICAL': 'bg_red',
+            },
+            style='{',
+            datefmt='%H:%M:%S'
+        ))
+        # Add the new handler
+        logging.getLogger('TMobile').addHandler(shandler)
+        log.debug('Finished setting up logging')
+
+    def _load_env_vars(self):
+        """
+            Loads environment variables
+        """
+        # Max number of inserts waiting to be inserted at once
+        try:
+            self.data_queue_limit = int(os.environ.get('DATA_QUEUE_LIMIT', 50))
+        except ValueError:
+            log.critical('Invalid DATA_QUEUE_LIMIT passed, must be a number')
+            exit(1)
+
+        # How long to wait in between scraping the gateway
+        try:
+            self.fetch_delay = int(os.environ.get('FETCH_DELAY', 10))
+            if self.fetch_delay < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid FETCH_DELAY passed, must be a positive number')
+            exit(1)
+
+        # Offset of scrapes within FETCH_DELAY
+        # "auto" spreads gateways out based on their name, or a number of seconds
+        self.fetch_phase = os.environ.get('FETCH_PHASE', 'auto').lower()
+        if self.fetch_phase != 'auto':
+            try:
+                self.fetch_phase = float(self.fetch_phase)
+            except ValueError:
+                log.critical('Invalid FETCH_PHASE passed, must be "auto" or a number')
+                exit(1)
+
+        # How often each endpoint is fetched in seconds, multiples of FETCH_DELAY
+        # e.g. "radio=2,lan=10,device=60", endpoints not listed are fetched every FETCH_DELAY
+        # Stored as the number of scrapes between fetches
+        self.fetch_every = dict.fromkeys(ENDPOINTS, 1)
+        try:
+            for interval in os.environ.get('FETCH_INTERVALS', '').split(','):
+                if not interval.strip():
+                    continue
+                endpoint, seconds = interval.split('=')
+                endpoint = endpoint.strip().lower()
+                seconds = int(seconds)
+                if endpoint not in ENDPOINTS or seconds < 1 or seconds % self.fetch_delay:
+                    raise ValueError
+                self.fetch_every[endpoint] = seconds // self.fetch_delay
+        except ValueError:
+            log.critical(
+                f'Invalid FETCH_INTERVALS passed, must be comma separated endpoint=seconds '
+                f'of {", ".join(ENDPOINTS)} with seconds a multiple of FETCH_DELAY'
+            )
+            exit(1)
+
+        # Port to serve the exporter's own metrics on, disabled if 0
+        try:
+            self.metrics_port = int(os.environ.get('METRICS_PORT', 0))
+        except ValueError:
+            log.critical('Invalid METRICS_PORT passed, must be a number')
+            exit(1)
+        self.metrics_host = os.environ.get('METRICS_HOST', '0.0.0.0')
+
+        # Log level to use
+        # 10/debug  20/info  30/warning  40/error
+        try:
+            self.log_level = int(os.environ.get('LOG_LEVEL', 20))
+        except ValueError:
+            log.critical('Invalid LOG_LEVEL passed, must be a number')
+            exit(1)
+
+        # Set the logging level
+        logging.root.setLevel(self.log_level)
+
+        # Max number of gateways being scraped at once
+        try:
+            self.gateway_concurrency = int(os.environ.get('GATEWAY_CONCURRENCY', 50))
+            if self.gateway_concurrency < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid GATEWAY_CONCURRENCY passed, must be a positive number')
+            exit(1)
+
+        # Gateways to scrape, either from a gateways file or a single gateway
+        # Replays get their gateways from the recordings instead
+        self.gateways = []
+        if self.replaying:
+            pass
+        elif gateways_file := os.environ.get('GATEWAYS_FILE'):
+            self._load_gateways_file(gateways_file)
+        else:
+            try:
+                self.gateways.append(Gateway(
+                    os.environ['GATEWAY_NAME'],
+                    os.environ['GATEWAY_URL']
+                ))
+            except KeyError as e:
+                log.critical(f'Missing required environment variable "{e.args[0]}"')
+                exit(1)
+
+        # Gateway connection pool, timeouts and keep-alive are in seconds
+        try:
+            self.gateway_connect_timeout = float(os.environ.get('GATEWAY_CONNECT_TIMEOUT', 5))
+            self.gateway_read_timeout = float(os.environ.get('GATEWAY_READ_TIMEOUT', 15))
+            self.gateway_keepalive = float(os.environ.get('GATEWAY_KEEPALIVE', 30))
+            # 0 is unlimited, defaults to enough for every endpoint of GATEWAY_CONCURRENCY gateways
+            self.gateway_connections = int(os.environ.get('GATEWAY_CONNECTIONS', len(ENDPOINTS) * self.gateway_concurrency))
+            self.gateway_connections_per_host = int(os.environ.get('GATEWAY_CONNECTIONS_PER_HOST', 3))
+        except ValueError:
+            log.critical(
+                'Invalid GATEWAY_CONNECT_TIMEOUT/GATEWAY_READ_TIMEOUT/GATEWAY_KEEPALIVE/'
+                'GATEWAY_CONNECTIONS/GATEWAY_CONNECTIONS_PER_HOST passed, must be a number'
+            )
+            exit(1)
+
+        # Split the gateways between SHARD_COUNT exporters, this one scrapes SHARD_INDEX's share
+        try:
+            self.shard_count = int(os.environ.get('SHARD_COUNT', 1))
+            self.shard_index = int(os.environ.get('SHARD_INDEX', 0))
+            if self.shard_count < 1 or not 0 <= self.shard_index < self.shard_count:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid SHARD_COUNT/SHARD_INDEX passed, SHARD_INDEX must be from 0 to SHARD_COUNT - 1')
+            exit(1)
+        if self.shard_count > 1 and not self.replaying:
+            total = len(self.gateways)
+            self.gateways = [
+                gateway for gateway in self.gateways if shard_of(gateway.name, self.shard_count) == self.shard_index
+            ]
+            log.info(f'Scraping {len(self.gateways)} of {total} gateways as shard {self.shard_index} of {self.shard_count}')
+            if not self.gateways:
+                log.warning('No gateways belong to this shard')
+
+        # ClickHouse connection info
+        try:
+            self.clickhouse_url = os.environ['CLICKHOUSE_URL']
+            self.clickhouse_user = os.environ['CLICKHOUSE_USER']
+            self.clickhouse_pass = os.environ['CLICKHOUSE_PASS']
+            self.clickhouse_db = os.environ['CLICKHOUSE_DB']
+        except KeyError as e:
+            # Print the key that was missing
+            log.critical(f'Missing required environment variable "{e.args[0]}"')
+            exit(1)
+
+        # Number of workers inserting batches into ClickHouse
+        try:
+            self.insert_workers = int(os.environ.get('INSERT_WORKERS', 4))
+            if self.insert_workers < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid INSERT_WORKERS passed, must be a positive number')
+            exit(1)
+
+        # Base and max delay in seconds between insert retries
+        try:
+            self.insert_retry_base = float(os.environ.get('INSERT_RETRY_BASE', 1))
+            self.insert_retry_max = float(os.environ.get('INSERT_RETRY_MAX', 60))
+        except ValueError:
+            log.critical('Invalid INSERT_RETRY_BASE/INSERT_RETRY_MAX passed, must be a number')
+            exit(1)
+
+        # Attempts before a batch ClickHouse keeps rejecting is dead-lettered
+        try:
+            self.insert_max_attempts = int(os.environ.get('INSERT_MAX_ATTEMPTS', 10))
+            if self.insert_max_attempts < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid INSERT_MAX_ATTEMPTS passed, must be a positive number')
+            exit(1)
+
+        # Connection failures in a row before pausing all inserts, and for how long
+        try:
+            self.insert_breaker_failures = int(os.environ.get('INSERT_BREAKER_FAILURES', 5))
+            self.insert_breaker_cooldown = float(os.environ.get('INSERT_BREAKER_COOLDOWN', 30))
+        except ValueError:
+            log.critical('Invalid INSERT_BREAKER_FAILURES/INSERT_BREAKER_COOLDOWN passed, must be a number')
+            exit(1)
+
+        # File to write batches that couldn't be inserted to, dropped if not set
+        self.dead_letter_file = os.environ.get('DEAD_LETTER_FILE')
+
+        # Directory to spool data to when the queue is full, disabled if not set
+        self.spool_dir = os.environ.get('SPOOL_DIR')
+
+        # Max total size of the spool in bytes
+        try:
+            self.spool_max_bytes = int(os.environ.get('SPOOL_MAX_BYTES', 1024 ** 3))
+        except ValueError:
+            log.critical('Invalid SPOOL_MAX_BYTES passed, must be a number')
+            exit(1)
+
+        # Max size of a single spool segment file in bytes
+        try:
+            self.spool_segment_bytes = int(os.environ.get('SPOOL_SEGMENT_BYTES', 1024 ** 2 * 4))
+        except ValueError:
+            log.critical('Invalid SPOOL_SEGMENT_BYTES passed, must be a number')
+            exit(1)
+
+        # Directory to record what gateways returned to, disabled if not set
+        self.record_dir = os.environ.get('RECORD_DIR')
+
+        # Max uncompressed size of a single recording segment file in bytes
+        try:
+            self.record_segment_bytes = int(os.environ.get('RECORD_SEGMENT_BYTES', 1024 ** 2 * 64))
+        except ValueError:
+            log.critical('Invalid RECORD_SEGMENT_BYTES passed, must be a number')
+            exit(1)
+
+        # Max number of rows in a single insert when replaying recordings
+        try:
+            self.replay_batch_rows = int(os.environ.get('REPLAY_BATCH_ROWS', 100000))
+            if self.replay_batch_rows < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid REPLAY_BATCH_ROWS passed, must be a positive number')
+            exit(1)
+
+        # Directory to save interface counters to so restarts don't lose a sample
+        self.counter_state_dir = os.environ.get('COUNTER_STATE_DIR')
+
+        # How often to save interface counters in seconds
+        try:
+            self.counter_state_interval = float(os.environ.get('COUNTER_STATE_INTERVAL', 60))
+            if self.counter_state_interval <= 0:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid COUNTER_STATE_INTERVAL passed, must be a positive number')
+            exit(1)
+
+        # Max age of saved interface counters to load in seconds
+        try:
+            self.counter_state_max_age = float(os.environ.get('COUNTER_STATE_MAX_AGE', 600))
+        except ValueError:
+            log.critical('Invalid COUNTER_STATE_MAX_AGE passed, must be a number')
+            exit(1)
+
+        # How often unchanged rows are still written in seconds, 0 writes every row
+        try:
+            self.dedup_heartbeat = float(os.environ.get('DEDUP_HEARTBEAT', 0))
+            if self.dedup_heartbeat < 0:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid DEDUP_HEARTBEAT passed, must be a positive number or 0')
+            exit(1)
+
+        # Tables only written on change or heartbeat
+        self.dedup_tables = [
+            table.strip().lower() for table in os.environ.get('DEDUP_TABLES', '5g,lte,status').split(',') if table.strip()
+        ]
+        if any(table not in ('5g', 'lte', 'status') for table in self.dedup_tables):
+            log.critical('Invalid DEDUP_TABLES passed, must be a comma separated list of "5g", "lte" and "status"')
+            exit(1)
+
+        # JSON codec used for gateway responses, ClickHouse and the spool
+        # "auto" uses the fastest installed one, or "orjson", "msgspec" or "json"
+        try:
+            self.json_codec = JsonCodec(os.environ.get('JSON_CODEC', 'auto').lower())
+        except ValueError as e:
+            log.critical(f'Invalid JSON_CODEC passed: {e}')
+            exit(1)
+        log.debug(f'Using the {self.json_codec.name} JSON codec')
+
+        # Length of rollup windows in seconds, disabled if 0
+        try:
+            self.rollup_window = int(os.environ.get('ROLLUP_WINDOW', 0))
+            if self.rollup_window < 0:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid ROLLUP_WINDOW passed, must be a positive number or 0')
+            exit(1)
+
+        # Tables rolled up when ROLLUP_WINDOW is set
+        self.rollup_tables = [
+            table.strip().lower() for table in os.environ.get('ROLLUP_TABLES', ','.join(ROLLUPS)).split(',') if table.strip()
+        ]
+        if any(table not in ROLLUPS for table in self.rollup_tables):
+            log.critical(f'Invalid ROLLUP_TABLES passed, must be a comma separated list of {", ".join(ROLLUPS)}')
+            exit(1)
+
+        # Fraction of raw rows still written for rolled up tables, 0 only writes rollups
+        try:
+            self.rollup_raw_sample = float(os.environ.get('ROLLUP_RAW_SAMPLE', 1))
+            if not 0 <= self.rollup_raw_sample <= 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid ROLLUP_RAW_SAMPLE passed, must be a number from 0 to 1')
+            exit(1)
+
+        # ClickHouse connection pool, timeouts and keep-alive are in seconds
+        try:
+            self.clickhouse_connect_timeout = float(os.environ.get('CLICKHOUSE_CONNECT_TIMEOUT', 10))
+            self.clickhouse_read_timeout = float(os.environ.get('CLICKHOUSE_READ_TIMEOUT', 300))
+            self.clickhouse_keepalive = float(os.environ.get('CLICKHOUSE_KEEPALIVE', 60))
+            # 0 is unlimited
+            self.clickhouse_connections = int(os.environ.get('CLICKHOUSE_CONNECTIONS', 10))
+        except ValueError:
+            log.critical(
+                'Invalid CLICKHOUSE_CONNECT_TIMEOUT/CLICKHOUSE_READ_TIMEOUT/CLICKHOUSE_KEEPALIVE/'
+                'CLICKHOUSE_CONNECTIONS passed, must be a number'
+            )
+            exit(1)
+
+        # How long to cache DNS lookups for in seconds
+        try:
+            self.dns_cache_ttl = int(os.environ.get('DNS_CACHE_TTL', 300))
+        except ValueError:
+            log.critical('Invalid DNS_CACHE_TTL passed, must be a number')
+            exit(1)
 
-        # Interface counters to compare difference to
-        self.interface_counters = {}
+        # Format used to send rows to ClickHouse
+        # values (INSERT ... VALUES through aiochclient) or rowbinary
+        self.insert_format = os.environ.get('INSERT_FORMAT', 'values').lower()
+        if self.insert_format not in ('values', 'rowbinary'):
+            log.critical('Invalid INSERT_FORMAT passed, must be "values" or "rowbinary"')
+            exit(1)
 
-    def _setup_logging(self):
-        """
-            Sets up logging colors and formatting
-        """
-        # Create a new handler with colors and formatting
-        shandler = logging.StreamHandler(stream=sys.stdout)
-        shandler.setFormatter(colorlog.LevelFormatter(
-            fmt={
-                'DEBUG': '{log_color}{asctime} [{levelname}] {message}',
-                'INFO': '{log_color}{asctime} [{levelname}] {message}',
-                'WARNING': '{log_color}{asctime} [{levelname}] {message}',
-                'ERROR': '{log_color}{asctime} [{levelname}] {message}',
-                'CRITICAL': '{log_color}{asctime} [{levelname}] {message}',
-            },
-            log_colors={
-                'DEBUG': 'blue',
-                'INFO': 'white',
-                'WARNING': 'yellow',
-                'ERROR': 'red',
-                'CRITICAL': 'bg_red',
-            },
-            style='{',
-            datefmt='%H:%M:%S'
-        ))
-        # Add the new handler
-        logging.getLogger('TMobile').addHandler(shandler)
-        log.debug('Finished setting up logging')
+        # HTTP compression used for rowbinary inserts
+        self.insert_compression = os.environ.get('INSERT_COMPRESSION', 'none').lower()
+        if self.insert_compression not in ('none', 'gzip', 'lz4'):
+            log.critical('Invalid INSERT_COMPRESSION passed, must be "none", "gzip" or "lz4"')
+            exit(1)
+        if self.insert_compression == 'lz4' and lz4 is None:
+            log.critical('INSERT_COMPRESSION "lz4" requires the lz4 package to be installed')
+            exit(1)
 
-    def _load_env_vars(self):
-        """
-            Loads environment variables
-        """
-        # Max number of inserts waiting to be inserted at once
+        # ClickHouse table names
+        self.clickhouse_tables = {
+            '5g': os.environ.get('CLICKHOUSE_5G_TABLE', 'tmobile_5g'),
+            'lte': os.environ.get('CLICKHOUSE_LTE_TABLE', 'tmobile_lte'),
+            'interfaces': os.environ.get('CLICKHOUSE_INTERFACES_TABLE', 'tmobile_interfaces'),
+            'status': os.environ.get('CLICKHOUSE_STATUS_TABLE', 'tmobile_status'),
+            'endpoints': os.environ.get('CLICKHOUSE_ENDPOINTS_TABLE', 'tmobile_endpoints'),
+            '5g_rollup': os.environ.get('CLICKHOUSE_5G_ROLLUP_TABLE', 'tmobile_5g_rollup'),
+            'lte_rollup': os.environ.get('CLICKHOUSE_LTE_ROLLUP_TABLE', 'tmobile_lte_rollup'),
+            'interfaces_rollup': os.environ.get('CLICKHOUSE_INTERFACES_ROLLUP_TABLE', 'tmobile_interfaces_rollup'),
+        }
+
+        # Max number of rows batched into a single insert per table
         try:
-            self.data_queue_limit = int(os.environ.get('DATA_QUEUE_LIMIT', 50))
+            self.insert_batch_rows = int(os.environ.get('INSERT_BATCH_ROWS', 1000))
+            if self.insert_batch_rows < 1:
+                raise ValueError
         except ValueError:
-            log.critical('Invalid DATA_QUEUE_LIMIT passed, must be a number')
+            log.critical('Invalid INSERT_BATCH_ROWS passed, must be a positive number')
             exit(1)
 
-        # How long to wait in between scraping the gateway
+        # Max number of seconds rows are batched for before being inserted
         try:
-            self.fetch_delay = int(os.environ.get('FETCH_DELAY', 10))
+            self.insert_batch_age = float(os.environ.get('INSERT_BATCH_AGE', 10))
         except ValueError:
-            log.critical('Invalid FETCH_DELAY passed, must be a number')
+            log.critical('Invalid INSERT_BATCH_AGE passed, must be a number')
             exit(1)
 
-        # Log level to use
-        # 10/debug  20/info  30/warning  40/error
+        # Max number of seconds spent inserting unsent rows on exit
         try:
-            self.log_level = int(os.environ.get('LOG_LEVEL', 20))
+            self.shutdown_timeout = float(os.environ.get('SHUTDOWN_TIMEOUT', 5))
+            if self.shutdown_timeout < 0:
+                raise ValueError
         except ValueError:
-            log.critical('Invalid LOG_LEVEL passed, must be a number')
+            log.critical('Invalid SHUTDOWN_TIMEOUT passed, must be a non-negative number')
             exit(1)
 
-        # Set the logging level
-        logging.root.setLevel(self.log_level)
+    def _load_gateways_file(self, path:str):
+        """
+            Loads the list of gateways to scrape from a JSON file
 
-        # ClickHouse connection info
+            The file must contain a list of objects with "name" and "url" keys
+        """
         try:
-            self.gateway_name = os.environ['GATEWAY_NAME']
-            self.gateway_url = os.environ['GATEWAY_URL']
-            self.clickhouse_url = os.environ['CLICKHOUSE_URL']
-            self.clickhouse_user = os.environ['CLICKHOUSE_USER']
-            self.clickhouse_pass = os.environ['CLICKHOUSE_PASS']
-            self.clickhouse_db = os.environ['CLICKHOUSE_DB']
-        except KeyError as e:
-            # Print the key that was missing
-            log.critical(f'Missing required environment variable "{e.args[0]}"')
+            with open(path) as f:
+                gateways = json.load(f)
+        except (OSError, ValueError) as e:
+            log.critical(f'Failed to load GATEWAYS_FILE "{path}": {e}')
             exit(1)
 
-        # ClickHouse table names
-        self.clickhouse_5g_table = os.environ.get(
-            'CLICKHOUSE_5G_TABLE',
-            'tmobile_5g'
-        )
-        self.clickhouse_lte_table = os.environ.get(
-            'CLICKHOUSE_LTE_TABLE',
-            'tmobile_lte'
-        )
-        self.clickhouse_interfaces_table = os.environ.get(
-            'CLICKHOUSE_INTERFACES_TABLE',
-            'tmobile_interfaces'
-        )
-        self.clickhouse_status_table = os.environ.get(
-            'CLICKHOUSE_STATUS_TABLE',
-            'tmobile_status'
-        )
+        if not isinstance(gateways, list) or not gateways:
+            log.critical('Invalid GATEWAYS_FILE passed, must be a non-empty list of gateways')
+            exit(1)
 
-    async def export(self):
-        log.info('Starting export')
-        while True:
+        names = set()
+        for gateway in gateways:
             try:
-                log.debug('Exporting...')
-                start = perf_counter()
-
-                async with self.session.get(f'{self.gateway_url}/fastmile_radio_status_web_app.cgi', timeout=15) as resp:
-                    radio_data = json.loads(await resp.text())
-                async with self.session.get(f'{self.gateway_url}/lan_status_web_app.cgi?lan', timeout=15) as resp:
-                    lan_data = json.loads(await resp.text())
-                async with self.session.get(F'{self.gateway_url}/dashboard_device_info_status_web_app.cgi', timeout=15) as resp:
-                    device_data = json.loads(await resp.text())
-                
-                latency = perf_counter() - start
-
-                # Get the current UTC timestamp
-                timestamp = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
-                try:
-                    self.data_queue.put_nowait([
-                            f"""
-                            INSERT INTO {self.clickhouse_5g_table} (
-                                gateway, physical_cell_id, snr, rsrp,
-                                rsrp_strength_index, rsrq, downlink_arfcn,
-                                signal_strength_level, band, time
-                            ) VALUES
-                            """,
-                            (
-                                self.gateway_name,
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['PhysicalCellID'],
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['SNRCurrent'],
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['RSRPCurrent'],
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['RSRPStrengthIndexCurrent'],
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['RSRQCurrent'],
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['Downlink_NR_ARFCN'],
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['SignalStrengthLevel'],
-                                radio_data['cell_5G_stats_cfg'][0]['stat']['Band'],
-                                timestamp                            
-                            )
-                    ])
-                except (KeyError, IndexError):
-                    # In case 5G isn't connected
-                    pass
+                name = gateway['name']
+                url = gateway['url']
+            except (KeyError, TypeError):
+                log.critical(f'Invalid gateway in GATEWAYS_FILE: {gateway}')
+                exit(1)
+            if name in names:
+                log.critical(f'Duplicate gateway name "{name}" in GATEWAYS_FILE')
+                exit(1)
+            names.add(name)
+
+            # Optional phase offset for this gateway
+            phase = gateway.get('phase')
+            if phase is not None:
                 try:
-                    self.data_queue.put_nowait([
-                            f"""
-                            INSERT INTO {self.clickhouse_lte_table} (
-                                gateway, physical_cell_id, rssi, snr,
-                                rsrp, rsrp_strength_index, rsrq, downlink_arfcn,
-                                signal_strength_level, band, time
-                            ) VALUES
-                            """,
-                            (
-                                self.gateway_name,
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['PhysicalCellID'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['RSSICurrent'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['SNRCurrent'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['RSRPCurrent'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['RSRPStrengthIndexCurrent'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['RSRQCurrent'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['DownlinkEarfcn'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['SignalStrengthLevel'],
-                                radio_data['cell_LTE_stats_cfg'][0]['stat']['Band'],
-                                timestamp
-                            )
-                    ])
-                except (KeyError, IndexError):
-                    # In case LTE isn't connected
-                    pass
+                    phase = float(phase)
+                except (ValueError, TypeError):
+                    log.critical(f'Invalid phase for gateway "{name}" in GATEWAYS_FILE, must be a number')
+                    exit(1)
 
-                wired_clients = 0
-                wireless_clients = 0
-                for client in device_data['device_cfg']:
-                    # Wired client
-                    if client['InterfaceType'] == 'Ethernet':
-                        wired_clients += 1
-                    # Wireless client (802.11)
-                    elif client['InterfaceType'] == '802.11':
-                        wireless_clients += 1
-
-                self.data_queue.put_nowait([
-                    f"""
-                    INSERT INTO {self.clickhouse_status_table} (
-                        gateway, uptime, connected, version, model,
-                        wired_devices, wireless_devices, scrape_latency
-                    ) VALUES
-                    """,
-                    (
-                        self.gateway_name,
-                        device_data['device_app_status'][0]['UpTime'],
-                        radio_data['connection_status'][0]['ConnectionStatus'],
-                        device_data['device_app_status'][0]['SoftwareVersion'],
-                        device_data['device_app_status'][0]['Description'],
-                        wired_clients,
-                        wireless_clients,
-                        latency                    
-                    )
-                ])
-
-                interfaces = []
-
-                # Ethernet ports
-                for iface_num in range(len(lan_data['lan_ether'])):
-                    iface = lan_data['lan_ether'][iface_num]
-                    if iface['Status'] == 'Down':
-                        continue
+            self.gateways.append(Gateway(name, url, phase))
 
-                    try:
-                        # Compare the current interface with the previous one
-                        bytes_rx = max(int(iface['stat']['BytesReceived']) - self.interface_counters[f'lan{iface_num}']['bytes_rx'], 0)
-                        bytes_tx = max(int(iface['stat']['BytesSent']) - self.interface_counters[f'lan{iface_num}']['bytes_tx'], 0)
-                        packets_rx = max(int(iface['stat']['PacketsReceived']) - self.interface_counters[f'lan{iface_num}']['packets_rx'], 0)
-                        packets_tx = max(int(iface['stat']['PacketsSent']) - self.interface_counters[f'lan{iface_num}']['packets_tx'], 0)
-                    except KeyError:
-                        # Interface is new, don't do anything and proceed to updating the counters
-                        pass
-                    else:
-                        interfaces.append((
-                            self.gateway_name,
-                            f'eth{iface_num}',
-                            bytes_rx,
-                            bytes_tx,
-                            packets_rx,
-                            packets_tx,
-                            timestamp
-                        ))
-
-                    # Update the counters
-                    self.interface_counters[f'lan{iface_num}'] = {
-                        'bytes_rx': max(int(iface['stat']['BytesReceived']), 0),
-                        'bytes_tx': max(int(iface['stat']['BytesSent']), 0),
-                        'packets_rx': max(int(iface['stat']['PacketsReceived']), 0),
-                        'packets_tx': max(int(iface['stat']['PacketsSent']), 0)
-                    }
+        log.info(f'Loaded {len(self.gateways)} gateways from {path}')
 
-                # WLAN radios
-                for iface_num in range(len(lan_data['wlan_status_glb'])):
-                    iface = lan_data['wlan_status_glb'][iface_num]
-                    if iface['Enable'] != 1:
-                        continue
+    async def export(self, gateway:Gateway):
+        """
+            Scrapes a gateway every FETCH_DELAY seconds and queues the data for insertion
+        """
+        phase = self.gateway_phase(gateway)
+        log.info(f'Starting export for {gateway.name} (phase {round(phase, 3)}s)')
+        # Number of the current scrape, and the scrape each endpoint is next due
+        tick = -1
+        next_due = dict.fromkeys(self.fetch_every, 0)
+        # Scrape on a fixed cadence regardless of how long each scrape takes
+        async for skipped in ticks(self.fetch_delay, phase):
+            tick += 1 + skipped
+            if skipped:
+                self.metric_scrapes_skipped.inc(skipped)
+                log.warning(f'Skipped {skipped} scrapes of {gateway.name}, scraping took longer than FETCH_DELAY')
+            # Endpoints due this scrape, and ones that failed last time
+            endpoints = [
+                endpoint for endpoint in self.fetch_every
+                if tick >= next_due[endpoint] or gateway.payloads[endpoint] is None
+            ]
+            # No endpoint is due this scrape
+            if not endpoints:
+                continue
+            for endpoint in endpoints:
+                next_due[endpoint] = tick + self.fetch_every[endpoint]
+            try:
+                # Wait for a free slot if too many gateways are being scraped at once
+                async with self.gateway_semaphore:
+                    await self.scrape(gateway, endpoints)
+            except Exception:
+                log.exception(f'Failed to update gateway data for {gateway.name}')
 
-                    try:
-                        # Compare the current interface with the previous one
-                        bytes_rx = max(int(iface['TotalBytesReceived']) - self.interface_counters[f'wlan{iface_num}']['bytes_rx'], 0)
-                        bytes_tx = max(int(iface['TotalBytesSent']) - self.interface_counters[f'wlan{iface_num}']['bytes_tx'], 0)
-                        packets_rx = max(int(iface['TotalPacketsReceived']) - self.interface_counters[f'wlan{iface_num}']['packets_rx'], 0)
-                        packets_tx = max(int(iface['TotalPacketsSent']) - self.interface_counters[f'wlan{iface_num}']['packets_tx'], 0)
-                    except KeyError:
-                        # Interface is new, don't do anything and proceed to updating the counters
-                        pass
-                    else:
-                        interfaces.append((
-                            self.gateway_name,
-                            f'wlan{iface_num}',
-                            bytes_rx,
-                            bytes_tx,
-                            packets_rx,
-                            packets_tx,
-                            timestamp
-                        ))
-
-                    # Update the counters
-                    self.interface_counters[f'wlan{iface_num}'] = {
-                        'bytes_rx': max(int(iface['TotalBytesReceived']), 0),
-                        'bytes_tx': max(int(iface['TotalBytesSent']), 0),
-                        'packets_rx': max(int(iface['TotalPacketsReceived']), 0),
-                        'packets_tx': max(int(iface['TotalPacketsSent']), 0)
-                    }
+    def gateway_phase(self, gateway:Gateway) -> float:
+        """
+            Returns the offset of a gateway's scrapes within FETCH_DELAY
+        """
+        if gateway.phase is not None:
+            phase = gateway.phase
+        elif self.fetch_phase == 'auto':
+            # Spread gateways out deterministically so they don't all scrape at once
+            phase = zlib.crc32(gateway.name.encode()) / 2 ** 32 * self.fetch_delay
+        else:
+            phase = self.fetch_phase
+        return phase % self.fetch_delay
 
-                # LAN bridge
-                iface = lan_data['lan_ifip']
-                try:
-                    # Compare the current interface with the previous one
-                    bytes_rx = max(int(iface['X_ASB_COM_RxBytes']) - self.interface_counters['bridge']['bytes_rx'], 0)
-                    bytes_tx = max(int(iface['X_ASB_COM_TxBytes']) - self.interface_counters['bridge']['bytes_tx'], 0)
-                    packets_rx = max(int(iface['X_ASB_COM_RxPackets']) - self.interface_counters['bridge']['packets_rx'], 0)
-                    packets_tx = max(int(iface['X_ASB_COM_TxPackets']) - self.interface_counters['bridge']['packets_tx'], 0)
-                except KeyError:
-                    # Interface is new, don't do anything and proceed to updating the counters
-                    pass
-                else:
-                    interfaces.append((
-                        self.gateway_name,
-                        'bridge',
-                        bytes_rx,
-                        bytes_tx,
-                        packets_rx,
-                        packets_tx,
-                        timestamp
-                    ))
-
-                # Update the counters
-                self.interface_counters['bridge'] = {
-                    'bytes_rx': max(int(iface['X_ASB_COM_RxBytes']), 0),
-                    'bytes_tx': max(int(iface['X_ASB_COM_TxBytes']), 0),
-                    'packets_rx': max(int(iface['X_ASB_COM_RxPackets']), 0),
-                    'packets_tx': max(int(iface['X_ASB_COM_TxPackets']), 0)
-                }
-
-                # Cellular
-                iface = radio_data['cellular_stats'][0]
+    def queue_rows(self, data:tuple) -> bool:
+        """
+            Queues a table's rows for insertion, spooling them to disk if the queue is full
 
-                try:
-                    # Compare the current interface with the previous one
-                    bytes_rx = max(int(iface['BytesReceived']) - self.interface_counters['cellular']['bytes_rx'], 0)
-                    bytes_tx = max(int(iface['BytesSent']) - self.interface_counters['cellular']['bytes_tx'], 0)
-                    # The API doesn't return packets in/out on the cellular interface
-                except KeyError:
-                    # Interface is new, don't do anything and proceed to updating the counters
-                    pass
-                else:
-                    interfaces.append((
-                        self.gateway_name,
-                        'cell',
-                        bytes_rx,
-                        bytes_tx,
-                        None,
-                        None,
-                        timestamp
-                    ))
-
-                # Update the counters
-                self.interface_counters['cellular'] = {
-                    'bytes_rx': max(int(iface['BytesReceived']), 0),
-                    'bytes_tx': max(int(iface['BytesSent']), 0),
-                }
-
-                log.debug(f'Got interface data: {interfaces}')
-
-                if interfaces:
-                    self.data_queue.put_nowait([
-                        f"""
-                        INSERT INTO {self.clickhouse_interfaces_table} (
-                            gateway, interface, bytes_in, bytes_out,
-                            packets_in, packets_out, time
-                        ) VALUES
-                        """,
-                        interfaces
-                    ])
-
-                log.info(f'Export took {round(latency, 2)}s')
-            except asyncio.QueueFull:
-                log.error('Failed to insert data into ClickHouse, queue is full')
-            except Exception:
-                log.exception('Failed to update gateway data')
-            finally:
-                # Wait the interval before updating again
-                await asyncio.sleep(self.fetch_delay)
+            Returns False if the rows were dropped
+        """
+        try:
+            self.data_queue.put_nowait(data)
+        except asyncio.QueueFull:
+            return self.overflow(*data)
+        return True
+
+    def overflow(self, table:str, rows:list, reason:str='queue_full') -> bool:
+        """
+            Spools rows that can't be inserted yet, or drops them if there's no spool
+
+            Returns False if the rows were dropped
+        """
+        if self.spool is None:
+            self.metric_rows_dropped.inc(len(rows), table, reason)
+            return False
+        self.spool.append(table, rows)
+        self.metric_rows_spooled.inc(len(rows), table)
+        return True
+
+    async def fetch(self, gateway:Gateway, endpoint:str) -> tuple:
+        """
+            Fetches an endpoint from a gateway
+
+            Returns the parsed data (or None if the fetch failed) and how long it took
+        """
+        start = perf_counter()
+        try:
+            async with self.gateway_session.get(f'{gateway.url}{ENDPOINTS[endpoint]}') as resp:
+                resp.raise_for_status()
+                data = self.json_codec.loads(await resp.read())
+        except asyncio.TimeoutError:
+            log.error(f'Timed out fetching {endpoint} data from {gateway.name}')
+            data = None
+        except Exception as e:
+            log.error(f'Failed to fetch {endpoint} data from {gateway.name}: "{e}"')
+            data = None
+
+        latency = perf_counter() - start
+        self.metric_scrape_latency.observe(latency, endpoint)
+        if data is None:
+            self.metric_scrape_errors.inc(1, endpoint)
+        return data, latency
+
+    async def scrape(self, gateway:Gateway, endpoints:list=tuple(ENDPOINTS)):
+        """
+            Scrapes a gateway once and queues the data for insertion
+
+            Only the given endpoints are fetched, the others reuse the data
+            from when they were last fetched
+        """
+        log.debug(f'Exporting {gateway.name}...')
+        start = perf_counter()
+
+        # Fetch the endpoints at the same time
+        results = await asyncio.gather(*(
+            self.fetch(gateway, endpoint) for endpoint in endpoints
+        ))
+        fetched = dict(zip(endpoints, results))
+
+        latency = perf_counter() - start
+
+        # Get the current UTC timestamp
+        timestamp = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+
+        # Keep what the gateway returned so it can be replayed later
+        if self.recorder is not None:
+            self.recorder.append(gateway.name, timestamp, latency, fetched)
+
+        # Tables whose rows were dropped because the queue is full
+        dropped = [data[0] for data in self.process(gateway, fetched, timestamp, latency) if not self.queue_rows(data)]
+        if dropped:
+            log.error(f'Failed to insert {", ".join(dropped)} data for {gateway.name} into ClickHouse, queue is full')
+            # The next rows have to be written even if they're unchanged
+            if self.dedup is not None:
+                for table in dropped:
+                    self.dedup.forget(gateway.name, table)
+
+        log.debug(f'Export for {gateway.name} took {round(latency, 2)}s')
+
+    def process(self, gateway:Gateway, fetched:dict, timestamp:float, latency:float) -> list:
+        """
+            Turns the data from a scrape into rows
+
+            fetched has the data (None if the fetch failed) and latency of each
+            endpoint fetched in the scrape, the other endpoints reuse the data
+            from when they were last fetched. Returns the (table, rows) to insert.
+        """
+        queued = []
+        # Nothing was due this scrape
+        if not fetched:
+            return queued
+
+        # Endpoints with new data
+        fresh = set()
+        for endpoint, (data, _) in fetched.items():
+            gateway.payloads[endpoint] = data
+            if data is not None:
+                fresh.add(endpoint)
+
+        # Per-endpoint latency so slow endpoints can be spotted
+        queued.append(('endpoints', [
+            (
+                gateway.name,
+                endpoint,
+                endpoint_latency,
+                data is not None,
+                timestamp
+            )
+            for endpoint, (data, endpoint_latency) in fetched.items()
+        ]))
+
+        if not fresh:
+            log.error(f'Failed to fetch any data from {gateway.name}')
+            return queued
+
+        payloads = gateway.payloads
+
+        # Values that don't come straight from the endpoints
+        values = {
+            'gateway': gateway.name,
+            'scrape_latency': latency,
+            'time': timestamp,
+        }
+        if payloads['device'] is not None:
+            wired_clients = 0
+            wireless_clients = 0
+            for client in payloads['device']['device_cfg']:
+                # Wired client
+                if client['InterfaceType'] == 'Ethernet':
+                    wired_clients += 1
+                # Wireless client (802.11)
+                elif client['InterfaceType'] == '802.11':
+                    wireless_clients += 1
+            values['wired_devices'] = wired_clients
+            values['wireless_devices'] = wireless_clients
+
+        for table, extractor in self.extractors.items():
+            # Skip tables that need endpoints that failed
+            if any(payloads[endpoint] is None for endpoint in extractor.endpoints):
+                continue
+            # Skip tables with nothing new since the last scrape
+            if fresh.isdisjoint(extractor.endpoints):
+                continue
+            try:
+                row = extractor.extract(payloads, values)
+            except (KeyError, IndexError):
+                # In case 5G/LTE isn't connected
+                log.debug(f'No {table} data from {gateway.name}')
+                if self.dedup is not None:
+                    self.dedup.forget(gateway.name, table)
+                continue
+            # Skip raw rows left out by rollup sampling
+            if not self.roll_up(table, [row], queued):
+                continue
+            # Skip rows that haven't changed since the last one written
+            if self.dedup is not None and not self.dedup.changed(gateway.name, table, row):
+                self.metric_rows_deduplicated.inc(1, table)
+                continue
+            queued.append((table, [row]))
+
+        # Turn the interface counters into deltas since the last scrape
+        interfaces = []
+        for mapping in INTERFACE_COUNTERS:
+            # Only count interfaces from endpoints fetched this scrape
+            if mapping.endpoint not in fresh:
+                continue
+            payload = payloads[mapping.endpoint]
+            for name, iface in mapping.interfaces(payload):
+                deltas = self.counters.update(gateway.name, name, mapping.values(iface), mapping.width)
+                # Interface is new, there's nothing to compare to yet
+                if deltas is None:
+                    continue
+                interfaces.append((
+                    gateway.name,
+                    name,
+                    *mapping.pad(deltas),
+                    timestamp
+                ))
+
+        log.debug(f'Got interface data: {interfaces}')
+
+        interfaces = self.roll_up('interfaces', interfaces, queued)
+        if interfaces:
+            queued.append(('interfaces', interfaces))
+
+        return queued
+
+    def roll_up(self, table:str, rows:list, queued:list) -> list:
+        """
+            Adds rows to their rollups and returns the raw rows that should still be written
+
+            Finished rollups are added to queued
+        """
+        if self.rollups is None or table not in self.rollups.columns:
+            return rows
+        for row in rows:
+            if finished := self.rollups.add(table, row):
+                queued.append((f'{table}_rollup', finished))
+        return [row for row in rows if self.rollups.sample(table, row)]
+
+    async def flush_rollups(self):
+        """
+            Queues the rollups of series that stopped getting rows (e.g. a cell handover)
+        """
+        while True:
+            await asyncio.sleep(self.rollup_window)
+            for table, rows in self.rollups.expired(time()).items():
+                if not self.queue_rows((f'{table}_rollup', rows)):
+                    log.error(f'Failed to insert {table} rollups into ClickHouse, queue is full')
 
     async def insert_to_clickhouse(self):
         """
-            Gets data from the data queue and inserts it into ClickHouse
+            Gets data from the data queue and batches it into inserts per table
+
+            A table's batch is inserted once it has INSERT_BATCH_ROWS rows
+            or its oldest row is INSERT_BATCH_AGE seconds old. Batches are
+            handed to the workers without waiting, so a table whose worker is
+            busy (e.g. retrying) doesn't hold up the others.
+        """
+        # Tables whose worker couldn't take their batch last time
+        blocked = set()
+        while True:
+            # Wait for new data until the oldest batch is due
+            timeout = None
+            if due := [since for table, since in self.pending_since.items() if table not in blocked]:
+                timeout = max(min(due) + self.insert_batch_age - monotonic(), 0)
+            # Check on blocked tables every second
+            if blocked:
+                timeout = 1 if timeout is None else min(timeout, 1)
+
+            try:
+                async with asyncio.timeout(timeout):
+                    table, rows = await self.data_queue.get()
+            except asyncio.TimeoutError:
+                pass
+            else:
+                # Check the data from the queue
+                if rows:
+                    if table not in self.pending_rows:
+                        self.pending_rows[table] = []
+                        self.pending_since[table] = monotonic()
+                    self.pending_rows[table].extend(rows)
+
+            # Insert any batches that are full or too old
+            now = monotonic()
+            blocked.clear()
+            for table, rows in list(self.pending_rows.items()):
+                if (
+                    len(rows) < self.insert_batch_rows
+                    and now - self.pending_since[table] < self.insert_batch_age
+                ):
+                    continue
+                try:
+                    self.table_queues[table].put_nowait((table, rows, None))
+                except asyncio.QueueFull:
+                    blocked.add(table)
+                    # Keep batching until the worker is free, unless the batch is full
+                    if len(rows) < self.insert_batch_rows:
+                        continue
+                    if not self.overflow(table, rows):
+                        log.error(f'Failed to insert {len(rows)} {table} rows into ClickHouse, insert queue is full')
+                del self.pending_rows[table]
+                del self.pending_since[table]
+
+    async def dispatch(self, table:str, rows:list, done:asyncio.Future):
+        """
+            Hands a replayed batch to the insert worker for its table, waiting for room
+
+            Each table always goes to the same worker so its batches are inserted
+            in order. done is resolved once the batch has been dealt with.
+        """
+        await self.table_queues[table].put((table, rows, done))
+
+    async def insert_worker(self, queue:asyncio.Queue):
+        """
+            Inserts batches from an insert queue one at a time
+        """
+        while True:
+            table, rows, done = await queue.get()
+            # Replayed batches are still in the spool, so don't spool them again on exit
+            await self.insert_batch(table, rows, spool_on_exit=done is None)
+            if done is not None and not done.done():
+                done.set_result(None)
+            queue.task_done()
+
+    async def replay_spool(self):
+        """
+            Replays spooled segments once inserts are succeeding again
         """
         while True:
-            # Get and check data from the queue
-            if not (data := await self.data_queue.get()):
+            if not (self.spool and self.clickhouse_healthy) or self.data_queue.full():
+                await asyncio.sleep(1)
                 continue
+            if (segment := self.spool.oldest()) is None:
+                continue
+
+            log.info(f'Replaying spooled segment {segment}')
+            batches = []
+            for table, rows in self.spool.read(segment).items():
+                for i in range(0, len(rows), self.insert_batch_rows):
+                    done = self.loop.create_future()
+                    await self.dispatch(table, rows[i:i + self.insert_batch_rows], done)
+                    batches.append(done)
+            # The segment is kept until it's fully replayed
+            await asyncio.gather(*batches)
+            self.spool.remove(segment)
+
+    def retry_delay(self, attempt:int) -> float:
+        """
+            Returns a jittered exponential backoff delay for a retry attempt
+        """
+        delay = min(self.insert_retry_base * 2 ** (attempt - 1), self.insert_retry_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def dead_letter(self, table:str, rows:list, error:Exception):
+        """
+            Gives up on a batch, writing it to the dead-letter file if there is one
+        """
+        self.metric_rows_dead_lettered.inc(len(rows), table)
+        if not self.dead_letter_file:
+            log.error(f'Dropping {len(rows)} rows for {table} after {self.insert_max_attempts} failed attempts')
+            return
+
+        log.error(f'Dead-lettering {len(rows)} rows for {table} after {self.insert_max_attempts} failed attempts')
+        try:
+            with open(self.dead_letter_file, 'ab') as f:
+                f.write(self.json_codec.dumps({'time': time(), 'table': table, 'error': str(error), 'rows': rows}) + b'\n')
+        except OSError as e:
+            log.error(f'Failed to write to DEAD_LETTER_FILE: {e}')
 
-            # Keep trying until the insert succeeds
-            while True:
-                log.debug(f'Got data to insert: {data}')
+    async def insert_rows(self, table:str, rows:list):
+        """
+            Inserts rows into a table using the configured insert format
+        """
+        columns = ', '.join(column for column, _, _ in TABLE_COLUMNS[table])
+
+        if self.insert_format == 'values':
+            await self.clickhouse.execute(
+                f'INSERT INTO {self.clickhouse_tables[table]} ({columns}) VALUES',
+                *rows
+            )
+            return
+
+        # Encode the rows into RowBinary, skipping any that don't fit the column types
+        encode = self.rowbinary_encoders[table]
+        data = bytearray()
+        for row in rows:
+            size = len(data)
+            try:
+                encode(data, row)
+            except (ValueError, TypeError, struct.error) as e:
+                # Sometimes the gateway returns invalid 5G/LTE data
+                del data[size:]
+                self.metric_rows_dropped.inc(1, table, 'invalid')
+                log.error(f'Insert into {table} failed for invalid data {row}: "{e}"')
+        if not data:
+            return
+
+        headers = {**self.clickhouse.headers}
+        if self.insert_compression == 'gzip':
+            data = gzip.compress(data, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        elif self.insert_compression == 'lz4':
+            data = lz4.frame.compress(data)
+            headers['Content-Encoding'] = 'lz4'
+
+        async with self.clickhouse_session.post(
+            self.clickhouse.url,
+            params={
+                **self.clickhouse.params,
+                'query': f'INSERT INTO {self.clickhouse_tables[table]} ({columns}) FORMAT RowBinary'
+            },
+            headers=headers,
+            data=bytes(data)
+        ) as resp:
+            if resp.status != 200:
+                raise aiochclient.ChClientError(
+                    (await resp.text()).strip() or f'Received error response with status code {resp.status} and empty body'
+                )
+
+    async def insert_batch(self, table:str, rows:list, spool_on_exit:bool=True):
+        """
+            Inserts a batch of rows into a table
+
+            Connection failures and overload errors are retried until ClickHouse
+            is back, while batches ClickHouse keeps rejecting are dead-lettered after
+            INSERT_MAX_ATTEMPTS attempts
+        """
+        # Batches that still need inserting, split up if ClickHouse can't parse them
+        batches = [rows]
+        # Failed attempts of the current batch and connection failures in a row
+        attempts = 0
+        failures = 0
+        try:
+            while batches:
+                batch = batches[-1]
+                # Wait while ClickHouse is down
+                await self.breaker.wait()
+                log.debug(f'Inserting {len(batch)} rows into {table}')
                 try:
-                    # Insert the data into ClickHouse
-                    # Check if the data is a list (bulk insert)
-                    if isinstance(data[1], list):
-                        await self.clickhouse.execute(
-                            data[0], # Query
-                            *data[1] # Data
-                        )
-                        log.debug(f'Inserted data for timestamp {data[1][-1]}')
-                    else:
-                        await self.clickhouse.execute(
-                            data[0], # Query
-                            data[1] # Data
-                        )
-                        log.debug(f'Inserted data for timestamp {data[1][-1]}')
-                    # Insert succeeded, break the loop and move on
-                    break
-                except IndexError:
-                    # Data was invalid somehow, skip it
-                    log.error(f'Invalid data: {data}')
-                # Insertion failed
+                    start = perf_counter()
+                    await self.insert_rows(table, batch)
+                    self.metric_insert_latency.observe(perf_counter() - start, table)
+                    self.metric_insert_rows.observe(len(batch), table)
+                    log.debug(f'Inserted {len(batch)} rows into {table}')
                 except Exception as e:
+                    # ClickHouse is unreachable or overloaded
+                    if clickhouse_unavailable(e):
+                        log.error(f'Insert of {len(batch)} rows into {table} failed: "{e}"')
+                        self.clickhouse_healthy = False
+                        self.metric_insert_retries.inc(1, table)
+                        await self.breaker.failure()
+                        failures += 1
+                        # Wait before retrying so we don't spam retries
+                        await asyncio.sleep(self.retry_delay(failures))
+                        continue
+
+                    # ClickHouse rejected the insert
+                    # ClickHouse answered, so it's up
+                    await self.breaker.success()
+                    failures = 0
+
                     # Check if it was a parsing error
                     # Sometimes the gateway returns invalid 5G/LTE data
                     if 'Cannot parse' in f'{e}':
-                        log.error(f'Insert failed for invalid data {data}')
-                        break
-                    try:
-                        log.error(f'Insert failed for timestamp {data[1][-1]}: "{e}"')
-                    except IndexError:
-                        # Sometimes the data is super invalid somehow and the log message fails
-                        # Catch it and fallback so we don't stop inserting future data
-                        log.error(f'Insert failed: "{e}"')
+                        batches.pop()
+                        attempts = 0
+                        if len(batch) == 1:
+                            self.metric_rows_dropped.inc(1, table, 'invalid')
+                            log.error(f'Insert into {table} failed for invalid data {batch[0]}')
+                            continue
+                        # Split the batch so only the invalid rows are dropped
+                        middle = len(batch) // 2
+                        batches.extend((batch[middle:], batch[:middle]))
+                        continue
+
+                    attempts += 1
+                    log.error(f'Insert of {len(batch)} rows into {table} failed (attempt {attempts}): "{e}"')
+                    if attempts >= self.insert_max_attempts:
+                        # Give up so the batch stops blocking the ones behind it
+                        batches.pop()
+                        attempts = 0
+                        self.dead_letter(table, batch, e)
+                        continue
+                    self.metric_insert_retries.inc(1, table)
+                    await asyncio.sleep(self.retry_delay(attempts))
+                else:
+                    batches.pop()
+                    attempts = 0
+                    failures = 0
+                    self.clickhouse_healthy = True
+                    await self.breaker.success()
+        except asyncio.CancelledError:
+            # Exiting, spool whatever wasn't inserted so it isn't lost
+            if spool_on_exit:
+                for batch in batches:
+                    if not self.overflow(table, batch, 'shutdown'):
+                        log.error(f'Dropped {len(batch)} {table} rows that weren\'t inserted before exiting')
+            raise
 
-                    # Wait before retrying so we don't spam retries
-                    await asyncio.sleep(2)
+    async def flush_unsent(self):
+        """
+            Inserts the rows that are still batched, queued or being rolled up on exit
 
-    async def run(self):
-        # Create a ClientSession that doesn't verify SSL certificates
-        self.session = aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=False)
+            Gives up after SHUTDOWN_TIMEOUT seconds, rows that are left are
+            spooled, or dropped if there's no spool
+        """
+        # Unsent rows by table, oldest first
+        unsent = {}
+        for queue in self.insert_queues:
+            while not queue.empty():
+                table, rows, done = queue.get_nowait()
+                queue.task_done()
+                # Replayed batches are still in the spool
+                if done is None:
+                    unsent.setdefault(table, []).extend(rows)
+        for table, rows in self.pending_rows.items():
+            unsent.setdefault(table, []).extend(rows)
+        self.pending_rows.clear()
+        self.pending_since.clear()
+        while not self.data_queue.empty():
+            table, rows = self.data_queue.get_nowait()
+            unsent.setdefault(table, []).extend(rows)
+        # Unfinished rollup windows are written as they are, the rest of the window gets its own row
+        if self.rollups is not None:
+            for table, rows in self.rollups.flush().items():
+                unsent.setdefault(f'{table}_rollup', []).extend(rows)
+
+        if any(unsent.values()):
+            log.info(f'Inserting {sum(map(len, unsent.values()))} unsent rows before exiting')
+        flushes = [
+            self.insert_batch(table, rows[i:i + self.insert_batch_rows])
+            for table, rows in unsent.items()
+            for i in range(0, len(rows), self.insert_batch_rows)
+        ]
+        try:
+            # Wait for the batches the workers are inserting too
+            async with asyncio.timeout(self.shutdown_timeout):
+                await asyncio.gather(*flushes, *(queue.join() for queue in self.insert_queues))
+        except TimeoutError:
+            log.warning(f'Unsent rows weren\'t inserted within SHUTDOWN_TIMEOUT ({self.shutdown_timeout}s)')
+
+    async def save_counters(self):
+        """
+            Periodically saves the interface counters of every gateway
+        """
+        while True:
+            await asyncio.sleep(self.counter_state_interval)
+            for gateway in self.gateways:
+                self.counters.save(gateway.name)
+
+    async def monitor_loop_lag(self, interval:float=0.5):
+        """
+            Measures how late the event loop wakes up from sleeps
+        """
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(interval)
+            self.metric_loop_lag.observe(max(self.loop.time() - start - interval, 0))
+
+    async def serve_metrics(self):
+        """
+            Serves the exporter's own metrics over HTTP
+        """
+        async def handler(_):
+            return web.Response(
+                text=self.metrics.render(),
+                content_type='text/plain',
+                charset='utf-8',
+                headers={'X-Content-Type-Options': 'nosniff'}
+            )
+
+        app = web.Application()
+        app.router.add_get('/metrics', handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.metrics_host, self.metrics_port).start()
+        log.info(f'Serving metrics on {self.metrics_host}:{self.metrics_port}')
+        return runner
+
+    def _trace_config(self, pool:str) -> aiohttp.TraceConfig:
+        """
+            Creates a trace config that tracks the usage of a connection pool in the metrics
+        """
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.metric_http_in_flight.inc(1, pool)
+
+        async def on_request_end(session, context, params):
+            self.metric_http_in_flight.inc(-1, pool)
+
+        async def on_connection_queued_start(session, context, params):
+            context.queued_at = perf_counter()
+
+        async def on_connection_queued_end(session, context, params):
+            self.metric_http_pool_wait.observe(perf_counter() - context.queued_at, pool)
+
+        async def on_connection_create_end(session, context, params):
+            self.metric_http_connections.inc(1, pool, 'new')
+
+        async def on_connection_reuseconn(session, context, params):
+            self.metric_http_connections.inc(1, pool, 'reused')
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_end)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def _open_sessions(self):
+        """
+            Creates the gateway and ClickHouse HTTP sessions
+
+            Each has its own connection pool so neither side can use up the
+            connections the other needs
+        """
+        # Neither verifies SSL certificates, gateways use self-signed ones
+        self.gateway_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=False,
+                limit=self.gateway_connections,
+                limit_per_host=self.gateway_connections_per_host,
+                keepalive_timeout=self.gateway_keepalive,
+                ttl_dns_cache=self.dns_cache_ttl
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=self.gateway_connect_timeout,
+                sock_read=self.gateway_read_timeout
+            ),
+            trace_configs=[self._trace_config('gateway')]
+        )
+        self.clickhouse_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=False,
+                limit=self.clickhouse_connections,
+                keepalive_timeout=self.clickhouse_keepalive,
+                ttl_dns_cache=self.dns_cache_ttl
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=self.clickhouse_connect_timeout,
+                sock_read=self.clickhouse_read_timeout
+            ),
+            trace_configs=[self._trace_config('clickhouse')]
         )
         self.clickhouse = aiochclient.ChClient(
-            self.session,
-            url=os.environ['CLICKHOUSE_URL'],
-            user=os.environ['CLICKHOUSE_USER'],
-            password=os.environ['CLICKHOUSE_PASS'],
-            database=os.environ['CLICKHOUSE_DB'],
-            json=json
+            self.clickhouse_session,
+            url=self.clickhouse_url,
+            user=self.clickhouse_user,
+            password=self.clickhouse_pass,
+            database=self.clickhouse_db,
+            json=self.json_codec
         )
 
-        # Run the exporter in a task
-        asyncio.create_task(self.export())
+    async def replay(self, paths:list):
+        """
+            Replays recordings into ClickHouse as fast as possible
+
+            Scrapes go through the same processing as live ones (with fresh
+            interface counters) and are inserted in batches of
+            REPLAY_BATCH_ROWS rows
+        """
+        self._open_sessions()
+        # Counters saved by live exporters don't match the recordings
+        self.counters = CounterDeltas()
+
+        workers = [asyncio.create_task(self.insert_worker(queue)) for queue in self.insert_queues]
+        # Gateways seen in the recordings by name
+        gateways = {}
+        # Rows waiting to be batched per table, and the batches being inserted
+        pending = {}
+        batches = []
+        scrapes = 0
+        start = perf_counter()
+
+        async def insert(table:str):
+            done = self.loop.create_future()
+            await self.dispatch(table, pending.pop(table), done)
+            batches.append(done)
+
+        try:
+            # Segment names start with when they were started, so sorting them replays them in order
+            for path in sorted(paths):
+                log.info(f'Replaying {path}')
+                for scrape in Recorder.read(path, self.json_codec):
+                    if (gateway := gateways.get(scrape['gateway'])) is None:
+                        gateway = gateways[scrape['gateway']] = Gateway(scrape['gateway'], '')
+                    fetched = {endpoint: tuple(result) for endpoint, result in scrape['endpoints'].items()}
+                    for table, rows in self.process(gateway, fetched, scrape['time'], scrape['latency']):
+                        pending.setdefault(table, []).extend(rows)
+                        if len(pending[table]) >= self.replay_batch_rows:
+                            await insert(table)
+                    scrapes += 1
+
+            # Insert the rest, including unfinished rollups
+            if self.rollups is not None:
+                for table, rows in self.rollups.flush().items():
+                    pending.setdefault(f'{table}_rollup', []).extend(rows)
+            for table in list(pending):
+                await insert(table)
+            await asyncio.gather(*batches)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self._close_sessions()
+
+        took = perf_counter() - start
+        log.info(f'Replayed {scrapes} scrapes from {len(gateways)} gateways in {round(took, 2)}s')
+
+    async def _close_sessions(self):
+        """
+            Closes the HTTP sessions so aiohttp doesn't complain
+        """
+        await self.gateway_session.close()
+        await self.clickhouse_session.close()
+
+    async def run(self):
+        self._open_sessions()
+
+        # Load saved interface counters so the first scrape has something to compare to
+        for gateway in self.gateways:
+            self.counters.load(gateway.name)
+
+        # Run an exporter task for each gateway
+        tasks = [
+            asyncio.create_task(self.export(gateway)) for gateway in self.gateways
+        ]
+
+        # Start the ClickHouse batcher and insert workers
+        tasks.append(asyncio.create_task(self.insert_to_clickhouse()))
+        workers = [asyncio.create_task(self.insert_worker(queue)) for queue in self.insert_queues]
+
+        # Replay spooled data once ClickHouse is reachable
+        if self.spool is not None:
+            tasks.append(asyncio.create_task(self.replay_spool()))
+
+        # Finish rollups of series that went quiet
+        if self.rollups is not None:
+            tasks.append(asyncio.create_task(self.flush_rollups()))
 
-        # Start the ClickHouse inserter
-        asyncio.create_task(self.insert_to_clickhouse())
+        # Periodically save interface counters
+        if self.counter_state_dir:
+            tasks.append(asyncio.create_task(self.save_counters()))
+
+        # Serve the exporter's own metrics
+        metrics_runner = None
+        if self.metrics_port:
+            tasks.append(asyncio.create_task(self.monitor_loop_lag()))
+            metrics_runner = await self.serve_metrics()
 
         # Run forever (or until we get SIGTERM'd)
         await self.event.wait()
         # If we got here, we are exiting
         log.info('Exiting')
-        # Close the aiohttp session so it doesn't complain
-        await self.session.close()
 
-loop = asyncio.new_event_loop()
-tmobile = TMobile(loop)
+        # Stop scraping and batching, the insert workers finish what they have
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Save the latest interface counters for the next start
+        for gateway in self.gateways:
+            self.counters.save(gateway.name)
+
+        # Insert whatever wasn't sent yet
+        await self.flush_unsent()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+        if self.spool is not None:
+            self.spool.close()
+            if self.spool:
+                log.info(f'Spooled {self.spool.size} bytes of data for the next start')
+        if self.recorder is not None:
+            self.recorder.close()
+        await self._close_sessions()
+
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+
+    # Replay recordings instead of exporting, e.g. "python tmobile.py replay /data/recordings/*.jsonl.gz"
+    if sys.argv[1:2] == ['replay']:
+        tmobile = TMobile(loop, replay=True)
+        loop.run_until_complete(tmobile.replay(sys.argv[2:]))
+        sys.exit()
+
+    tmobile = TMobile(loop)
 
-# Handle SIGTERM
-def sigterm_handler(_, __):
-    # Set the event to stop the loop
-    tmobile.event.set()
-# Register the SIGTERM handler
-signal.signal(signal.SIGTERM, sigterm_handler)
+    # Handle SIGTERM
+    def sigterm_handler(_, __):
+        # Set the event to stop the loop
+        tmobile.event.set()
+    # Register the SIGTERM handler
+    signal.signal(signal.SIGTERM, sigterm_handler)
 
-loop.run_until_complete(tmobile.run())
\ No newline at end of file
+    loop.run_until_complete(tmobile.run())